@@ -0,0 +1,190 @@
+import os
+import cv2
+import csv
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+
+from color_lut import (classes_from_parameters, get_lut, uses_lut, convert, label_image, label_counts, class_masks,
+                       masks_to_labels)
+from process_directory import process_directory, render_overlay, csv_header, csv_row, image_result
+from streamlit_app import thresholding, apply_mask
+from instrumentation import peak_rss_mb
+
+# Default thresholds so the benchmark doesn't depend on whatever is saved in parameters.json
+PARAMETERS = {"Green H lower": 23, "Green H upper": 255, "Gilgai H lower": 0, "Gilgai H upper": 14,
+              "Green S lower": 0, "Green S upper": 255, "Gilgai S lower": 0, "Gilgai S upper": 255,
+              "Green V lower": 0, "Green V upper": 255, "Gilgai V lower": 0, "Gilgai V upper": 255}
+
+SIZES = {"vga": (480, 640), "hd": (1080, 1920), "12mp": (3000, 4000)}
+
+# A stage has regressed when it is this much slower than the baseline, and by more than timing noise
+REGRESSION_TOLERANCE = 0.2
+NOISE_SECONDS = 0.001
+
+
+def synthetic_field(height, width, seed=0):
+    # Noisy green crop with smoothed red-brown patches standing in for gilgai, so no images need downloading
+    rng = np.random.default_rng(seed)
+    img = np.empty((height, width, 3), np.uint8)
+    img[:] = (40, 140, 70)
+    for _ in range(max(3, height * width // 200000)):
+        centre = (int(rng.integers(width)), int(rng.integers(height)))
+        axes = (int(rng.integers(width // 40, width // 8)), int(rng.integers(height // 40, height // 8)))
+        cv2.ellipse(img, centre, axes, float(rng.uniform(0, 180)), 0, 360, (50, 80, 150), -1)
+
+    noise = rng.normal(0, 12, img.shape)
+    return cv2.GaussianBlur(np.clip(img + noise, 0, 255).astype(np.uint8), (5, 5), 0)
+
+
+def write_images(directory, count, size, extension=".jpg"):
+    height, width = SIZES[size]
+    for i in range(count):
+        cv2.imwrite(os.path.join(directory, f"synthetic_{i:05d}{extension}"), synthetic_field(height, width, i))
+
+
+def measure(function, *args, repeats=3, **kwargs):
+    # Best of a few runs for time, then one more run for the peak of numpy/Python allocations. tracemalloc slows
+    # every allocation down, so it is never running while the time is taken.
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, {"seconds": min(timings), "peak_mb": peak / 2 ** 20}
+
+
+def bench_stages(img_path, classes, csv_path):
+    stages = {}
+    img, stages["decode"] = measure(cv2.imread, img_path)
+
+    # process_directory stages: one lookup in the table for many classes, otherwise one inRange mask per class
+    if uses_lut(classes):
+        lut = get_lut(classes)
+        packed, stages["convert"] = measure(convert, img, "packed")
+        labels, stages["mask"] = measure(label_image, img, lut, packed)
+        counts, stages["count"] = measure(label_counts, labels, len(classes))
+    else:
+        converted, stages["convert"] = measure(convert, img, "HSV")
+        masks, stages["mask"] = measure(class_masks, converted, classes)
+        counts, stages["count"] = measure(lambda: [cv2.countNonZero(mask) for mask in masks])
+        labels = masks_to_labels(masks)
+    percentages = [count / labels.size * 100 for count in counts]
+    _, stages["overlay"] = measure(render_overlay, img, labels, len(classes))
+
+    def write_csv():
+        with open(csv_path, "w", newline="") as csv_file:
+            csv_writer = csv.writer(csv_file)
+            csv_writer.writerow(csv_header(classes))
+            csv_writer.writerow(csv_row(image_result(img_path, classes, percentages)))
+
+    _, stages["csv"] = measure(write_csv)
+
+    # streamlit_app stages, each class converts and masks the image again
+    _, stages["streamlit_convert"] = measure(cv2.cvtColor, img, cv2.COLOR_BGR2HSV)
+    for _, lower, upper in classes:
+        _, timing = measure(thresholding, img, np.array(lower), np.array(upper), "HSV")
+        stages["streamlit_thresholding"] = add_timings(stages.get("streamlit_thresholding"), timing)
+        _, timing = measure(apply_mask, img, np.array(lower), np.array(upper), (0, 0, 255), "HSV")
+        stages["streamlit_apply_mask"] = add_timings(stages.get("streamlit_apply_mask"), timing)
+
+    return stages
+
+
+def add_timings(total, timing):
+    if total is None:
+        return timing
+
+    return {"seconds": total["seconds"] + timing["seconds"], "peak_mb": max(total["peak_mb"], timing["peak_mb"])}
+
+
+def run_benchmarks(sizes, counts, workers):
+    classes = classes_from_parameters(PARAMETERS)
+    report = {}
+    with tempfile.TemporaryDirectory() as directory:
+        parameters_path = os.path.join(directory, "parameters.json")
+        with open(parameters_path, "w") as json_file:
+            json.dump(PARAMETERS, json_file)
+
+        for size in sizes:
+            megapixels = SIZES[size][0] * SIZES[size][1] / 1e6
+            image_directory = os.path.join(directory, size)
+            os.makedirs(image_directory)
+            write_images(image_directory, max(counts), size)
+
+            first_image = os.path.join(image_directory, sorted(os.listdir(image_directory))[0])
+            report[f"{size}/stages"] = bench_stages(first_image, classes, os.path.join(directory, "stage.csv"))
+
+            for count in counts:
+                count_directory = os.path.join(directory, f"{size}_{count}")
+                os.makedirs(count_directory)
+                for file_name in sorted(os.listdir(image_directory))[:count]:
+                    os.link(os.path.join(image_directory, file_name), os.path.join(count_directory, file_name))
+
+                _, timing = measure(process_directory, count_directory, parameters_path,
+                                    os.path.join(directory, "output.csv"), workers=workers, repeats=1)
+                timing["images_per_second"] = count / timing["seconds"]
+                timing["megapixels_per_second"] = count * megapixels / timing["seconds"]
+                report[f"{size}/process_directory_{count}"] = {"total": timing}
+
+    report["max_rss_mb"] = peak_rss_mb()
+    return report
+
+
+def compare(report, baseline, tolerance=REGRESSION_TOLERANCE):
+    regressions = []
+    for case, stages in report.items():
+        if not isinstance(stages, dict) or case not in baseline:
+            continue
+        for stage, timing in stages.items():
+            previous = baseline[case].get(stage)
+            if previous is not None and timing["seconds"] > previous["seconds"] * (1 + tolerance) + NOISE_SECONDS:
+                regressions.append(f"{case} {stage}: {previous['seconds'] * 1000:.2f} ms -> "
+                                   f"{timing['seconds'] * 1000:.2f} ms")
+
+    return regressions
+
+
+def print_report(report):
+    for case, stages in report.items():
+        if not isinstance(stages, dict):
+            print(f"{case}: {stages:.1f}")
+            continue
+        for stage, timing in stages.items():
+            line = f"{case:<32} {stage:<24} {timing['seconds'] * 1000:10.2f} ms {timing['peak_mb']:9.1f} MB"
+            if "images_per_second" in timing:
+                line += f" {timing['images_per_second']:8.1f} img/s {timing['megapixels_per_second']:8.1f} MP/s"
+            print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each stage of the segmentation pipeline on synthetic images.")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=["vga", "hd"])
+    parser.add_argument("--counts", nargs="+", type=int, default=[10], help="number of images in each directory")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--baseline", default="benchmark_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.sizes, args.counts, args.workers)
+    print_report(report)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as json_file:
+            json.dump(report, json_file, indent=2)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as json_file:
+            regressions = compare(report, json.load(json_file))
+        for regression in regressions:
+            print(f"Slower than baseline: {regression}")
+        if regressions:
+            raise SystemExit(1)
@@ -0,0 +1,223 @@
+import os
+import cv2
+import csv
+import argparse
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+from gilgai_detection import load_slider_values
+from color_lut import COLOR_CONVERSIONS, classes_from_parameters, pack_pixels
+from process_directory import list_images, csv_header, csv_row
+
+# Value range of each channel for 8-bit images in OpenCV, hue only goes up to 180
+CHANNEL_RANGES = {"HSV": (180, 256, 256), "LAB": (256, 256, 256), "RGB": (256, 256, 256)}
+
+# Histogram bins per channel, 0 keeps the exact colour counts instead
+DEFAULT_BINS = 32
+
+
+def color_counts(img, color_space="HSV"):
+    # Every distinct colour in the image with its number of pixels, exact for any thresholds and usually far smaller
+    # than the image itself. Colours are packed as c0 | c1 << 8 | c2 << 16.
+    if color_space in COLOR_CONVERSIONS:
+        img = cv2.cvtColor(img, COLOR_CONVERSIONS[color_space])
+    values, counts = np.unique(pack_pixels(img), return_counts=True)
+
+    return values.astype(np.uint32), counts.astype(np.uint32)
+
+
+def unpack_colors(values):
+    # One 8-bit array per channel, a quarter of the memory of unpacking into 32-bit columns
+    return [(values >> shift & 255).astype(np.uint8) for shift in (0, 8, 16)]
+
+
+def colors_inside(channels, lower, upper):
+    inside = np.ones(len(channels[0]), bool)
+    for channel, lower_value, upper_value in zip(channels, lower, upper):
+        inside &= (channel >= lower_value) & (channel <= upper_value)
+
+    return inside
+
+
+def counts_coverage(values, counts, lower, upper):
+    inside = colors_inside(unpack_colors(values), lower, upper)
+    return counts[inside].sum(dtype=np.int64) / max(counts.sum(dtype=np.int64), 1) * 100
+
+
+def image_histogram(img, color_space="HSV", bins=32):
+    if color_space in COLOR_CONVERSIONS:
+        img = cv2.cvtColor(img, COLOR_CONVERSIONS[color_space])
+
+    # Map each channel value to its bin with a 256 entry table, then count every (c0, c1, c2) bin at once
+    tables = np.stack([np.minimum(np.arange(256) * bins // value_range, bins - 1)
+                       for value_range in CHANNEL_RANGES[color_space]], axis=-1).astype(np.uint8)
+    binned = cv2.LUT(img, tables.reshape(1, 256, 3))
+    codes = (binned[..., 0].astype(np.int32) * bins + binned[..., 1]) * bins + binned[..., 2]
+
+    return np.bincount(codes.ravel(), minlength=bins ** 3).astype(np.uint32).reshape(bins, bins, bins)
+
+
+def summed_volume(histograms):
+    # Cumulative counts over the last three axes, padded with a zero plane so box sums need no edge cases
+    *leading, bins, _, _ = histograms.shape
+    sat = np.zeros((*leading, bins + 1, bins + 1, bins + 1), np.uint32)
+    sat[..., 1:, 1:, 1:] = histograms.cumsum(-3).cumsum(-2).cumsum(-1)
+
+    return sat
+
+
+def threshold_bins(lower, upper, color_space, bins):
+    # Thresholds are snapped to the bins they fall in, so the index is exact when bins matches the channel range
+    ranges = np.array(CHANNEL_RANGES[color_space])
+    lo = np.clip(np.asarray(lower), 0, ranges - 1) * bins // ranges
+    hi = np.clip(np.asarray(upper), 0, ranges - 1) * bins // ranges + 1
+
+    return lo, hi
+
+
+def box_count(sat, lo, hi):
+    # Inclusion-exclusion over the eight corners of the box, works for one table or a stack of them
+    total = np.zeros(sat.shape[:-3], np.int64)
+    for corner in range(8):
+        index = tuple(hi[axis] if corner >> axis & 1 else lo[axis] for axis in range(3))
+        sign = -1 if (3 - bin(corner).count("1")) % 2 else 1
+        total += sign * sat[(..., *index)].astype(np.int64)
+
+    return total
+
+
+def box_coverage(sat, lower, upper, color_space="HSV"):
+    # Nothing can match a lower bound above the channel range, snapping it into the last bin would count that bin
+    lower, upper = np.asarray(lower), np.asarray(upper)
+    if np.any(lower > upper) or np.any(lower > np.array(CHANNEL_RANGES[color_space]) - 1):
+        return np.zeros(sat.shape[:-3])
+
+    bins = sat.shape[-1] - 1
+    lo, hi = threshold_bins(lower, upper, color_space, bins)
+    total_pixels = sat[..., -1, -1, -1].astype(np.int64)
+
+    return box_count(sat, lo, hi) / total_pixels * 100
+
+
+def build_index(image_directory, color_space="HSV", bins=DEFAULT_BINS, workers=1):
+    # By default each image keeps a bins^3 histogram, which answers every query in constant time but snaps thresholds
+    # to the bins. bins=0 keeps the exact colour counts of each image instead, see index_boxes() for what they cost.
+    file_names = list_images(image_directory)
+
+    def summarise(file_name):
+        img = cv2.imread(os.path.join(image_directory, file_name))
+        return color_counts(img, color_space) if bins == 0 else image_histogram(img, color_space, bins)
+
+    # Decoding and converting release the GIL, so threads are enough to keep several cores busy
+    with ThreadPoolExecutor(max_workers=max(1, workers or os.cpu_count())) as pool:
+        summaries = list(pool.map(summarise, file_names))
+
+    index = {"file_names": file_names, "color_space": color_space, "bins": bins}
+    if bins == 0:
+        index["values"] = np.concatenate([values for values, _ in summaries] or [np.zeros(0, np.uint32)])
+        index["counts"] = np.concatenate([counts for _, counts in summaries] or [np.zeros(0, np.uint32)])
+        index["lengths"] = np.array([len(values) for values, _ in summaries], np.int64)
+    else:
+        index["histograms"] = (np.stack(summaries) if summaries
+                               else np.zeros((0, bins, bins, bins), np.uint32))
+
+    return index
+
+
+def save_index(index, index_path):
+    # Only the counts or histograms are stored, histograms are mostly empty and compress far better than the
+    # summed tables
+    arrays = {key: index[key] for key in ("values", "counts", "lengths", "histograms") if key in index}
+    np.savez_compressed(index_path, file_names=np.array(index["file_names"]), color_space=index["color_space"],
+                        bins=index["bins"], **arrays)
+
+
+def load_index(index_path):
+    with np.load(index_path) as data:
+        index = {"file_names": data["file_names"].tolist(), "color_space": str(data["color_space"]),
+                 "bins": int(data["bins"])}
+        for key in ("values", "counts", "lengths", "histograms"):
+            if key in data:
+                index[key] = data[key]
+
+    return index
+
+
+def index_boxes(index, boxes):
+    # Coverage for many (lower, upper) boxes at once, returns an array of shape (boxes, images)
+    if index["bins"] == 0:
+        # Exact counts are scanned one image at a time, so working memory is set by the image with the most colours
+        # (3 bytes each, plus a mask), but each box costs time in proportion to every colour in the index
+        coverages = np.zeros((len(boxes), len(index["file_names"])))
+        ends = np.cumsum(index["lengths"])
+        for i, (start, end) in enumerate(zip(ends - index["lengths"], ends)):
+            channels = unpack_colors(index["values"][start:end])
+            counts = index["counts"][start:end]
+            total = max(counts.sum(dtype=np.int64), 1)
+            for j, (lower, upper) in enumerate(boxes):
+                coverages[j, i] = counts[colors_inside(channels, lower, upper)].sum(dtype=np.int64) / total * 100
+
+        return coverages
+
+    # The summed tables are four times the size of the histograms, so they are only made when first queried
+    if "sat" not in index:
+        index["sat"] = summed_volume(index["histograms"])
+
+    return np.array([box_coverage(index["sat"], lower, upper, index["color_space"]) for lower, upper in boxes])
+
+
+def index_coverage(index, classes):
+    # Coverage of every class for every image in the index, one lookup per class for the whole directory
+    coverages = index_boxes(index, [(lower, upper) for _, lower, upper in classes])
+
+    return [{"file_name": file_name,
+             "percentages": {name: float(coverage[i]) for (name, _, _), coverage in zip(classes, coverages)}}
+            for i, file_name in enumerate(index["file_names"])]
+
+
+def threshold_sweep(index, boxes):
+    return index_boxes(index, boxes)
+
+
+def query_index(index_path, json_file_path="parameters.json", output_csv_path="output.csv"):
+    parameters = load_slider_values(json_file_path)
+    if parameters is None:
+        print("Error: No JSON file found.")
+        return
+
+    classes = classes_from_parameters(parameters)
+    results = index_coverage(load_index(index_path), classes)
+
+    with open(output_csv_path, "w", newline="") as csv_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(csv_header(classes))
+        for result in results:
+            csv_writer.writerow(csv_row(result))
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a colour histogram index of a directory once, then "
+                                                 "recalculate coverage for new thresholds without reading any images.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="index every image in a directory")
+    build_parser.add_argument("image_directory")
+    build_parser.add_argument("--index", default="color_index.npz")
+    build_parser.add_argument("--color-space", choices=list(CHANNEL_RANGES), default="HSV")
+    build_parser.add_argument("--bins", type=int, default=DEFAULT_BINS,
+                              help="bins per channel of the histogram, 0 keeps exact colour counts instead")
+    build_parser.add_argument("--workers", type=int, default=1, help="number of parallel workers (0 = one per core)")
+
+    query_parser = subparsers.add_parser("query", help="calculate coverage from an index")
+    query_parser.add_argument("--index", default="color_index.npz")
+    query_parser.add_argument("--parameters", default="parameters.json")
+    query_parser.add_argument("--output", default="output.csv")
+
+    args = parser.parse_args()
+    if args.command == "build":
+        save_index(build_index(args.image_directory, args.color_space, args.bins, args.workers), args.index)
+    else:
+        query_index(args.index, args.parameters, args.output)
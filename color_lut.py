@@ -0,0 +1,145 @@
+import cv2
+import numpy as np
+
+from functools import lru_cache
+
+COLOR_CONVERSIONS = {"HSV": cv2.COLOR_BGR2HSV, "LAB": cv2.COLOR_BGR2Lab}
+
+# Overlay colours (BGR) for each class in order, the first two match the original wheat/gilgai overlay
+CLASS_COLORS = [(0, 255, 0), (0, 0, 255), (255, 0, 0), (0, 255, 255),
+                (255, 0, 255), (255, 255, 0), (255, 255, 255), (0, 128, 255)]
+
+MAX_CLASSES = 16
+
+# Up to this many classes are thresholded with cvtColor and inRange, which OpenCV runs on every core and which skip
+# building a label image when only the counts are needed. With more classes one lookup in the table is cheaper than
+# a pass per class.
+INRANGE_CLASSES = 4
+
+
+def classes_from_parameters(parameters, channels="HSV"):
+    # Keys look like "Green H lower", so any number of classes can be added to parameters.json
+    names = []
+    for key in parameters:
+        name = key.rsplit(" ", 2)[0]
+        if name not in names:
+            names.append(name)
+
+    return tuple((name,
+                  tuple(int(parameters[f"{name} {ch} lower"]) for ch in channels),
+                  tuple(int(parameters[f"{name} {ch} upper"]) for ch in channels)) for name in names)
+
+
+def color_cube():
+    # Every 24-bit colour exactly once, pixel i holds the B, G and R bytes of i
+    return np.arange(1 << 24, dtype="<u4").view(np.uint8).reshape(4096, 4096, 4)[:, :, :3].copy()
+
+
+def compile_lut(classes, color_space="HSV"):
+    if len(classes) > MAX_CLASSES:
+        raise ValueError(f"At most {MAX_CLASSES} classes are supported, got {len(classes)}.")
+
+    cube = color_cube()
+    if color_space in COLOR_CONVERSIONS:
+        cube = cv2.cvtColor(cube, COLOR_CONVERSIONS[color_space])
+
+    # Each class sets one bit, so overlapping thresholds still count towards every class like separate masks would
+    dtype = np.uint8 if len(classes) <= 8 else np.uint16
+    lut = np.zeros(1 << 24, dtype)
+    for bit, (_, lower, upper) in enumerate(classes):
+        mask = cv2.inRange(cube, np.array(lower), np.array(upper)).ravel()
+        np.bitwise_or(lut, (mask > 0).astype(dtype) << bit, out=lut)
+
+    return lut
+
+
+@lru_cache(maxsize=4)
+def _cached_lut(classes, color_space):
+    return compile_lut(classes, color_space)
+
+
+# Tables compiled by another process, see seed_lut()
+_seeded_luts = {}
+
+
+def seed_lut(classes, color_space, lut):
+    # Used as a pool initializer, so each worker process uses the table compiled once by the parent
+    _seeded_luts[classes, color_space] = lut
+
+
+def get_lut(classes, color_space="HSV"):
+    # Always cached on both arguments, so get_lut(classes) and get_lut(classes, "HSV") share one table
+    lut = _seeded_luts.get((classes, color_space))
+    return lut if lut is not None else _cached_lut(classes, color_space)
+
+
+def uses_lut(classes):
+    return len(classes) > INRANGE_CLASSES
+
+
+def convert(img, layout):
+    # The form classification starts from: packed colour indices for the table, or the converted image for inRange
+    if layout == "packed":
+        return pack_pixels(img)
+    if layout in COLOR_CONVERSIONS:
+        return cv2.cvtColor(img, COLOR_CONVERSIONS[layout])
+
+    return img
+
+
+def pack_pixels(img):
+    # Pack B, G, R into one 32-bit index per pixel (top byte left at zero)
+    packed = np.zeros(img.shape[:2] + (4,), np.uint8)
+    cv2.mixChannels([img], [packed], [0, 0, 1, 1, 2, 2])
+
+    return packed.view("<u4")[..., 0]
+
+
+def label_image(img, lut, packed=None):
+    # Look every pixel up at once, the packed indices can be passed in if they were already made
+    return np.take(lut, pack_pixels(img) if packed is None else packed)
+
+
+def class_masks(converted, classes):
+    return [cv2.inRange(converted, np.array(lower), np.array(upper)) for _, lower, upper in classes]
+
+
+def masks_to_labels(masks):
+    # The same labels the table gives, one bit per class (only used for up to INRANGE_CLASSES, so always 8-bit)
+    labels = np.zeros(masks[0].shape, np.uint8)
+    for bit, mask in enumerate(masks):
+        cv2.bitwise_or(labels, cv2.bitwise_and(mask, 1 << bit), dst=labels)
+
+    return labels
+
+
+def label_counts(labels, n_classes):
+    # calcHist is faster than np.bincount, but only takes 8-bit labels and counts in float32, exact below 2^24
+    if labels.dtype == np.uint8 and labels.size < 1 << 24:
+        hist = cv2.calcHist([np.ascontiguousarray(labels)], [0], None, [256], [0, 256]).ravel().astype(np.int64)
+    else:
+        hist = np.bincount(labels.ravel(), minlength=1 << n_classes)
+    codes = np.arange(hist.size)
+
+    return [int(hist[(codes >> bit) & 1 == 1].sum()) for bit in range(n_classes)]
+
+
+def class_mask(labels, bit):
+    return cv2.compare(np.bitwise_and(labels, labels.dtype.type(1 << bit)), 0, cv2.CMP_NE)
+
+
+def classify_counts(img, classes, color_space="HSV", keep_labels=True):
+    # Pixel count of every class, and the label image when it is wanted (always made when the table is used)
+    if uses_lut(classes):
+        labels = label_image(img, get_lut(classes, color_space))
+        return labels, label_counts(labels, len(classes))
+
+    masks = class_masks(convert(img, color_space), classes)
+    return masks_to_labels(masks) if keep_labels else None, [cv2.countNonZero(mask) for mask in masks]
+
+
+def classify(img, classes, color_space="HSV", keep_labels=True):
+    labels, counts = classify_counts(img, classes, color_space, keep_labels)
+    percentages = [count / (img.shape[0] * img.shape[1]) * 100 for count in counts]
+
+    return labels, percentages
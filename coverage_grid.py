@@ -0,0 +1,51 @@
+import cv2
+import numpy as np
+
+from color_lut import class_mask
+
+
+def mask_integrals(masks):
+    # One integral image per class mask, shape (classes, height + 1, width + 1)
+    return np.stack([cv2.integral((mask > 0).view(np.uint8), sdepth=cv2.CV_32S) for mask in masks])
+
+
+def label_integrals(labels, n_classes):
+    return mask_integrals([class_mask(labels, bit) for bit in range(n_classes)])
+
+
+def save_integrals(path, integrals):
+    np.save(path, integrals)
+
+
+def load_integrals(path):
+    # Memory-mapped, so a query only reads the four corners it needs from disk
+    return np.load(path, mmap_mode="r")
+
+
+def rect_coverage(integrals, x0, y0, x1, y1):
+    # Percentage of each class inside the rectangle [x0, x1) x [y0, y1), four lookups per class
+    height, width = integrals.shape[1] - 1, integrals.shape[2] - 1
+    x0, x1 = sorted((int(np.clip(x0, 0, width)), int(np.clip(x1, 0, width))))
+    y0, y1 = sorted((int(np.clip(y0, 0, height)), int(np.clip(y1, 0, height))))
+    area = (x1 - x0) * (y1 - y0)
+    if area == 0:
+        return np.zeros(integrals.shape[0])
+
+    counts = (integrals[:, y1, x1].astype(np.int64) - integrals[:, y0, x1] - integrals[:, y1, x0]
+              + integrals[:, y0, x0])
+    return counts / area * 100
+
+
+def grid_coverage(integrals, rows, cols):
+    # Coverage of every class in each cell of a rows x cols grid, shape (rows, cols, classes)
+    height, width = integrals.shape[1] - 1, integrals.shape[2] - 1
+    y_edges = np.linspace(0, height, rows + 1).round().astype(int)
+    x_edges = np.linspace(0, width, cols + 1).round().astype(int)
+    y0, y1 = y_edges[:-1, None], y_edges[1:, None]
+    x0, x1 = x_edges[None, :-1], x_edges[None, 1:]
+
+    counts = (integrals[:, y1, x1].astype(np.int64) - integrals[:, y0, x1] - integrals[:, y1, x0]
+              + integrals[:, y0, x0])
+    area = np.maximum((y1 - y0) * (x1 - x0), 1)
+
+    return np.moveaxis(counts / area * 100, 0, -1)
@@ -0,0 +1,203 @@
+import os
+import cv2
+import json
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from gilgai_detection import load_slider_values
+from color_lut import classes_from_parameters, get_lut, uses_lut, classify
+from process_directory import image_result, process_image
+
+# A batch is sent to the pool once it has this many images, or once the first image in it has waited this long
+BATCH_SIZE = 16
+BATCH_WAIT_SECONDS = 0.005
+
+
+def classify_bytes(file_bytes, classes, file_name="upload"):
+    # For images posted in the request body rather than given as a path
+    img = cv2.imdecode(np.frombuffer(file_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f"Could not decode {file_name}.")
+
+    return image_result(file_name, classes, classify(img, classes, keep_labels=False)[1])
+
+
+class CoverageService:
+    # Keeps the thresholds, the compiled lookup table and a pool of threads loaded between requests. Requests from
+    # any number of connections go on one queue and are classified in small batches, OpenCV and numpy release the GIL
+    # so the threads run in parallel.
+
+    def __init__(self, json_file_path="parameters.json", workers=None, batch_size=BATCH_SIZE,
+                 batch_wait=BATCH_WAIT_SECONDS):
+        self.json_file_path = json_file_path
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.parameters_mtime = None
+        self.classes = None
+        self.load_parameters()
+
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        self.requests = queue.Queue()
+        self.stats = {"images": 0, "batches": 0, "errors": 0}
+        self.batcher = threading.Thread(target=self._batch_requests, daemon=True)
+        self.batcher.start()
+
+    def load_parameters(self):
+        # Thresholds saved again by gilgai_detection.py are picked up on the next batch without a restart
+        mtime = os.stat(self.json_file_path).st_mtime_ns
+        if mtime == self.parameters_mtime:
+            return
+
+        parameters = load_slider_values(self.json_file_path)
+        if parameters is None:
+            raise ValueError(f"No JSON file found at {self.json_file_path}.")
+        self.classes = classes_from_parameters(parameters)
+        if uses_lut(self.classes):
+            get_lut(self.classes)
+        self.parameters_mtime = mtime
+
+    def submit(self, item):
+        # item is an image path or (file_name, bytes), the future gets the same result dict as process_image()
+        future = Future()
+        self.requests.put((item, future))
+        return future
+
+    def classify(self, items):
+        futures = [self.submit(item) for item in items]
+        return [future.result() for future in futures]
+
+    def _classify(self, item, classes):
+        if isinstance(item, tuple):
+            return classify_bytes(item[1], classes, item[0])
+
+        result = process_image(item, classes)
+        result.pop("timings")
+        return result
+
+    def _batch_requests(self):
+        while True:
+            batch = [self.requests.get()]
+            if batch[0] is None:
+                return
+
+            # Gather whatever else arrives in the next few milliseconds, so concurrent requests share a batch
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    request = self.requests.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                # Finish this batch before stopping
+                if request is None:
+                    self.requests.put(None)
+                    break
+                batch.append(request)
+
+            try:
+                self.load_parameters()
+            except Exception as error:
+                # A file that is still being saved leaves the last thresholds in use
+                if self.classes is None:
+                    for _, future in batch:
+                        future.set_exception(error)
+                    continue
+
+            classes = self.classes
+            for (item, future), pool_future in [(request, self.pool.submit(self._classify, request[0], classes))
+                                                for request in batch]:
+                try:
+                    future.set_result(pool_future.result())
+                except Exception as error:
+                    self.stats["errors"] += 1
+                    future.set_exception(error)
+            self.stats["images"] += len(batch)
+            self.stats["batches"] += 1
+
+    def close(self):
+        self.requests.put(None)
+        self.batcher.join()
+        self.pool.shutdown()
+
+
+class CoverageHandler(BaseHTTPRequestHandler):
+    # GET /health reports the loaded classes and counters.
+    # POST /coverage takes JSON {"path": ...} or {"paths": [...]}, or the bytes of one image as the body.
+    service = None
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+        self.send_json(200, {"classes": [name for name, _, _ in self.service.classes], **self.service.stats})
+
+    def do_POST(self):
+        if self.path.split("?")[0] != "/coverage":
+            return self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                request = json.loads(body)
+                items = request["paths"] if "paths" in request else [request["path"]]
+                if not isinstance(items, list) or not all(isinstance(item, str) for item in items):
+                    raise ValueError("paths must be a list of image paths.")
+            else:
+                items = [(self.headers.get("X-File-Name", "upload"), body)]
+            results = self.service.classify(items)
+        except (ValueError, KeyError, TypeError, OSError, cv2.error) as error:
+            return self.send_json(400, {"error": str(error)})
+        except Exception as error:
+            # Anything else is a bug, but the client still gets an answer and the server keeps running
+            return self.send_json(500, {"error": f"{type(error).__name__}: {error}"})
+
+        self.send_json(200, {"results": [{"file_name": result["file_name"], "path": result["path"],
+                                          "percentages": result["percentages"]} for result in results]})
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # One line per request would be most of the output under load
+        pass
+
+
+def serve(json_file_path="parameters.json", host="127.0.0.1", port=8765, workers=None, batch_size=BATCH_SIZE,
+          batch_wait=BATCH_WAIT_SECONDS):
+    service = CoverageService(json_file_path, workers, batch_size, batch_wait)
+    handler = type("Handler", (CoverageHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Serving coverage on http://{host}:{server.server_port}/coverage")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep the classifier loaded and answer coverage requests over "
+                                                 "localhost HTTP.")
+    parser.add_argument("--parameters", default="parameters.json")
+    parser.add_argument("--host", default="127.0.0.1", help="only change this if other machines should have access")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=0, help="number of classifier threads (0 = one per core)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--batch-wait", type=float, default=BATCH_WAIT_SECONDS * 1000,
+                        help="milliseconds to wait for more requests to join a batch")
+    args = parser.parse_args()
+
+    serve(args.parameters, args.host, args.port, args.workers or None, args.batch_size, args.batch_wait / 1000)
@@ -0,0 +1,66 @@
+import cv2
+import numpy as np
+
+from color_lut import classify_counts
+
+# OpenCV can decode JPEGs at a half, quarter or eighth of their size, which is much faster than a full decode
+REDUCED_READ_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                      4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+REDUCED_DECODE_EXTENSIONS = (".jpg", ".jpeg")
+
+# Pixels classified between each check of the confidence intervals
+SAMPLE_BATCH = 10000
+
+
+def wilson_interval(count, n, population, z=1.96):
+    # Wilson score interval for a proportion, shrunk towards the sample proportion by the finite population
+    # correction so that it closes up completely once every pixel of the full-resolution image has been seen
+    p = count / n
+    denominator = 1 + z ** 2 / n
+    centre = (p + z ** 2 / (2 * n)) / denominator
+    half_width = z * np.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / denominator
+
+    correction = np.sqrt((population - n) / (population - 1)) if population > 1 else 0.0
+    centre = p + (centre - p) * correction
+    half_width *= correction
+
+    return max(0.0, centre - half_width) * 100, min(1.0, centre + half_width) * 100
+
+
+def estimate_coverage(img_path, classes, reduction=4, sample_size=None, tolerance=None, z=1.96, seed=0):
+    # The image is reduced to 1/reduction of its size, then pixels are classified in random batches until every
+    # interval is within +/- tolerance percentage points or sample_size pixels have been seen.
+    # Without either limit every pixel of the reduced image is used.
+
+    # Only JPEGs decode faster at a reduced size. Other formats are decoded whole and every reduction-th pixel is
+    # kept, since a reduced decode averages neighbouring pixels and moves small patches in or out of the thresholds.
+    if img_path.lower().endswith(REDUCED_DECODE_EXTENSIONS):
+        img = cv2.imread(img_path, REDUCED_READ_FLAGS[reduction])
+        population = None if img is None else img.shape[0] * img.shape[1] * reduction ** 2
+    else:
+        img = cv2.imread(img_path)
+        population = None if img is None else img.shape[0] * img.shape[1]
+        img = None if img is None else img[::reduction, ::reduction]
+    if img is None:
+        raise ValueError(f"Could not read {img_path}.")
+
+    # The interval is for the full-resolution image, so it only closes up once all of its pixels have been seen
+    pixels = img.reshape(-1, 3)
+    sample_size = len(pixels) if sample_size is None else min(sample_size, len(pixels))
+    order = np.random.default_rng(seed).permutation(len(pixels)) if sample_size < len(pixels) or tolerance else None
+
+    counts = np.zeros(len(classes), np.int64)
+    n = 0
+    while n < sample_size:
+        batch_size = sample_size - n if tolerance is None else min(SAMPLE_BATCH, sample_size - n)
+        batch = pixels[n:n + batch_size] if order is None else pixels[order[n:n + batch_size]]
+        counts += classify_counts(batch.reshape(-1, 1, 3), classes, keep_labels=False)[1]
+        n += batch_size
+
+        intervals = [wilson_interval(count, n, population, z) for count in counts]
+        if tolerance is not None and all((high - low) / 2 <= tolerance for low, high in intervals):
+            break
+
+    percentages = [count / n * 100 for count in counts]
+
+    return percentages, intervals, n
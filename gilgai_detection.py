@@ -1,5 +1,6 @@
 import cv2
 import json
+import time
 import numpy as np
 
 
@@ -14,13 +15,41 @@ def load_slider_values(file_path):
     except FileNotFoundError:
         return None
 
+# Seconds without a trackbar change before the full resolution result replaces the preview
+SETTLE_SECONDS = 0.3
+
+# Largest image (in pixels) that is masked while the trackbars are being dragged
+PREVIEW_PIXELS = 250000
+
+tuner_state = {"changed": True, "last_change": 0.0}
+
+
 def on_trackbar(*args):
-    pass
+    # Only record the change, the main loop decides when to recompute
+    tuner_state["changed"] = True
+    tuner_state["last_change"] = time.monotonic()
+
+
+def build_pyramid(img, max_pixels):
+    pyramid = [img]
+    while pyramid[-1].shape[0] * pyramid[-1].shape[1] > max_pixels:
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+
+    return pyramid
+
+
+def read_thresholds(class_name):
+    lower = np.array([cv2.getTrackbarPos(f"{class_name} {color} lower", "Parameters") for color in ["H", "S", "V"]])
+    upper = np.array([cv2.getTrackbarPos(f"{class_name} {color} upper", "Parameters") for color in ["H", "S", "V"]])
+
+    return lower, upper
+
 
 def gilgai_detection(image_path):
     # Load the image
-    img = cv2.imread(image_path)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    img_bgr = cv2.imread(image_path)
+    img = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2HSV)
+    height, width = img.shape[:2]
 
     # Create windows
     cv2.namedWindow("Output")
@@ -45,55 +74,61 @@ def gilgai_detection(image_path):
         for key, value in saved_values.items():
             cv2.setTrackbarPos(key, "Parameters", value)
 
-    while True:
-        # Get trackbar values for green wheat
-        green_lower = np.array([cv2.getTrackbarPos(f"Green {color} lower", "Parameters") for color in ["H", "S", "V"]])
-        green_upper = np.array([cv2.getTrackbarPos(f"Green {color} upper", "Parameters") for color in ["H", "S", "V"]])
-
-        # Get trackbar values for scolds
-        gilgai_lower = np.array([cv2.getTrackbarPos(f"Gilgai {color} lower", "Parameters") for color in ["H", "S", "V"]])
-        gilgai_upper = np.array([cv2.getTrackbarPos(f"Gilgai {color} upper", "Parameters") for color in ["H", "S", "V"]])
-
-        # Create masks for green wheat and white/red-brown scolds
-        green_mask = cv2.inRange(img, green_lower, green_upper)
-        gilgai_mask = cv2.inRange(img, gilgai_lower, gilgai_upper)
+    # Overlay percentage text on images
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    font_scale = 0.7
+    font_color = (255, 255, 255)
+    font_thickness = 2
+
+    # The output is allocated once: the original at twice the size on top, masked wheat and gilgai below.
+    # The original never changes, so it is resized and labelled only here.
+    stack = np.zeros((height * 3, width * 2, 3), np.uint8)
+    cv2.resize(img_bgr, (width * 2, height * 2), dst=stack[:height * 2])
+    cv2.putText(stack[:height * 2], "Original", (10, 30), font, font_scale, font_color, font_thickness)
+    outputs = {"Green": stack[height * 2:, :width], "Gilgai": stack[height * 2:, width:]}
+    labels = {"Green": "Wheat", "Gilgai": "Gilgai"}
+
+    # Smaller copies of the image are masked while the trackbars move, with buffers for each level made up front
+    bgr_levels = build_pyramid(img_bgr, PREVIEW_PIXELS)
+    hsv_levels = [img] + [cv2.cvtColor(level, cv2.COLOR_BGR2HSV) for level in bgr_levels[1:]]
+    masks = [np.empty(level.shape[:2], np.uint8) for level in bgr_levels]
+    previews = [np.empty_like(level) for level in bgr_levels]
+
+    cv2.imshow("Parameters", param_img)
+    full_resolution = False
 
-        masked_green = cv2.bitwise_and(img, img, mask=green_mask)
-        masked_green = cv2.cvtColor(masked_green, cv2.COLOR_HSV2BGR)
-
-        masked_gilgai = cv2.bitwise_and(img, img, mask=gilgai_mask)
-        masked_gilgai = cv2.cvtColor(masked_gilgai, cv2.COLOR_HSV2BGR)
+    while True:
+        dragging = time.monotonic() - tuner_state["last_change"] < SETTLE_SECONDS
 
-        # Calculate percentages
-        total_pixels = img.shape[0] * img.shape[1]
-        green_percentage = (np.sum(green_mask > 0) / total_pixels) * 100
-        gilgai_percentage = (np.sum(gilgai_mask > 0) / total_pixels) * 100
+        # Recompute only when a trackbar moved, then once more at full resolution when it stops
+        if tuner_state["changed"] or (not dragging and not full_resolution):
+            tuner_state["changed"] = False
+            level = len(bgr_levels) - 1 if dragging else 0
 
-        # Overlay percentage text on images
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        font_scale = 0.7
-        font_color = (255, 255, 255)
-        font_thickness = 2
+            for class_name, output in outputs.items():
+                # Create masks for green wheat and white/red-brown scolds
+                lower, upper = read_thresholds(class_name)
+                cv2.inRange(hsv_levels[level], lower, upper, dst=masks[level])
 
-        green_text = f"Wheat: {green_percentage:.2f}%"
-        scold_text = f"Gilgai: {gilgai_percentage:.2f}%"
+                # Calculate percentages
+                percentage = (np.count_nonzero(masks[level]) / masks[level].size) * 100
 
-        cv2.putText(masked_green, green_text, (10, 30), font, font_scale, font_color, font_thickness)
-        cv2.putText(masked_gilgai, scold_text, (10, 30), font, font_scale, font_color, font_thickness)
+                masked = output if level == 0 else previews[level]
+                masked.fill(0)
+                cv2.bitwise_and(bgr_levels[level], bgr_levels[level], dst=masked, mask=masks[level])
+                if level != 0:
+                    cv2.resize(masked, (width, height), dst=output, interpolation=cv2.INTER_NEAREST)
 
-        resized_img = cv2.resize(img, (img.shape[1] * 2, img.shape[0] * 2))
-        resized_img = cv2.cvtColor(resized_img, cv2.COLOR_HSV2BGR)
-        cv2.putText(resized_img, "Original", (10, 30), font, font_scale, font_color, font_thickness)
+                cv2.putText(output, f"{labels[class_name]}: {percentage:.2f}%", (10, 30), font, font_scale,
+                            font_color, font_thickness)
 
-        stack = np.hstack((masked_green, masked_gilgai))
-        stack = np.vstack((resized_img, stack))
+            full_resolution = level == 0
 
-        # Show masked images
-        cv2.imshow("Output", stack)
-        cv2.imshow("Parameters", param_img)
+            # Show masked images
+            cv2.imshow("Output", stack)
 
-        # Break the loop if 'q' is pressed
-        if cv2.waitKey(1) & 0xFF == ord("q"):
+        # Break the loop if 'q' is pressed, waiting a little longer keeps the loop idle between changes
+        if cv2.waitKey(20) & 0xFF == ord("q"):
             break
 
     slider_values = {}
@@ -1,44 +1,120 @@
 import os
 import csv
-from tkinter import Tk, Button, Label, Entry, Text, filedialog, messagebox, Scrollbar, Canvas, Frame, font
-from process_directory import process_directory
+import queue
+import threading
+from tkinter import Tk, Button, Label, Entry, Text, Checkbutton, IntVar, filedialog, messagebox, Scrollbar, Canvas, Frame, font, ttk
+from process_directory import stream_directory, load_overlay
+from gilgai_detection import load_slider_values
+from color_lut import classes_from_parameters
+from coverage_grid import rect_coverage
 
 from PIL import Image, ImageTk
 
+# How often the Tk thread checks for results from the background worker
+POLL_MS = 100
+
+# Largest side of the overlay shown on the canvas
+THUMBNAIL_SIZE = 600
+
 def browse_directory(entry):
     directory = filedialog.askdirectory()
     entry.delete(0, "end")
     entry.insert(0, directory)
 
-def process_directory_gui(image_directory, json_file_path, output_widget):
-    global images
+def process_directory_gui(image_directory, json_file_path, output_widget, estimate=False):
+    global images, worker_thread, run_classes
+    if worker_thread is not None and worker_thread.is_alive():
+        return
+
     if not os.path.exists(image_directory):
         messagebox.showerror("Error", "Please select a valid image directory.")
         return
 
-    results = process_directory(image_directory, json_file_path)
-    if not results:
+    parameters = load_slider_values(json_file_path)
+    if parameters is None:
         messagebox.showerror("Error", "No JSON file found.")
         return
 
-    images = results
-
-    if images:
-        # Display the first image
-        show_image_on_canvas(image_canvas, 0)
-    else:
-        messagebox.showerror("Error", "No images found in the selected directory.")
-
-    # Display the first image
-    show_image_on_canvas(image_canvas, 0)
+    # Overlays are drawn with the thresholds of this run, not whatever is saved later
+    run_classes = classes_from_parameters(parameters)
+    images = []
+    image_canvas.delete("all")
     update_image_navigation_buttons()
 
     output_widget.delete(1.0, "end")
     output_widget.insert("end", "Image Name\tGreen Wheat (%)\tGilgai (%)\n")
     output_widget.insert("end", "-" * 80 + "\n")
+    progress_bar.config(value=0, maximum=1)
 
-    for result in results:
-        output_widget.insert("end", f"{result['file_name']}\t{result['green_percentage']:.2f}\t{result['gilgai_percentage']:.2f}\n")
+    # Processing runs on a background thread so the window stays responsive, results come back through a queue
+    cancel_event.clear()
+    worker_thread = threading.Thread(target=process_in_background, args=(image_directory, parameters, estimate),
+                                     daemon=True)
+    worker_thread.start()
+
+    process_button["state"] = "disabled"
+    cancel_button["state"] = "normal"
+    root.after(POLL_MS, poll_results, output_widget)
+
+
+def process_in_background(image_directory, parameters, estimate):
+    # The fast estimate decodes each image at a quarter size and samples pixels until within +/- 1%
+    results = stream_directory(image_directory, parameters, estimate={"reduction": 4, "tolerance": 1.0} if estimate else None,
+                               progress=lambda done, total, result: result_queue.put(("result", done, total, result)))
+    try:
+        for _ in results:
+            if cancel_event.is_set():
+                results.close()
+                break
+    except Exception as error:
+        result_queue.put(("error", str(error)))
+
+    result_queue.put(("finished", cancel_event.is_set()))
+
+
+def poll_results(output_widget):
+    global images
+    while True:
+        try:
+            message = result_queue.get_nowait()
+        except queue.Empty:
+            root.after(POLL_MS, poll_results, output_widget)
+            return
+
+        if message[0] == "result":
+            _, done, total, result = message
+            images.append(result)
+            output_widget.insert("end", result_row(result))
+            progress_bar.config(value=done, maximum=total)
+
+            if len(images) == 1:
+                # Display the first image
+                show_image_on_canvas(image_canvas, 0)
+            else:
+                update_image_navigation_buttons()
+        elif message[0] == "error":
+            messagebox.showerror("Error", message[1])
+        elif message[0] == "finished":
+            process_button["state"] = "normal"
+            cancel_button["state"] = "disabled"
+            if not images and not message[1]:
+                messagebox.showerror("Error", "No images found in the selected directory.")
+            return
+
+
+def cancel_processing():
+    cancel_event.set()
+    cancel_button["state"] = "disabled"
+
+
+def result_row(result):
+    if "intervals" in result:
+        green_low, green_high = result["intervals"]["Green"]
+        gilgai_low, gilgai_high = result["intervals"]["Gilgai"]
+        return (f"{result['file_name']}\t{result['green_percentage']:.2f} ({green_low:.2f}-{green_high:.2f})"
+                f"\t{result['gilgai_percentage']:.2f} ({gilgai_low:.2f}-{gilgai_high:.2f})\n")
+
+    return f"{result['file_name']}\t{result['green_percentage']:.2f}\t{result['gilgai_percentage']:.2f}\n"
 
 
 def set_threshold_values():
@@ -46,16 +122,29 @@ def set_threshold_values():
 
 
 def show_image_on_canvas(canvas, image_index):
-    global images, current_image_index
+    global images, current_image_index, current_integrals
     current_image_index = image_index
-    img = images[image_index]["image"]
 
-    # Update the tkinter window size based on the image size
-    root.geometry()
+    # Overlays are rendered only for the image being shown and only at thumbnail size
+    canvas.delete("all")
+    try:
+        img, current_integrals = load_overlay(images[image_index]["path"], max_size=THUMBNAIL_SIZE, integrals=True,
+                                              classes=run_classes)
+    except (ValueError, OSError) as error:
+        # e.g. the file was moved or replaced after it was processed, the row is kept but nothing can be drawn
+        img, current_integrals = None, None
+        canvas.config(width=THUMBNAIL_SIZE, height=THUMBNAIL_SIZE // 2)
+        canvas.create_text(THUMBNAIL_SIZE // 2, THUMBNAIL_SIZE // 4, text=str(error), width=THUMBNAIL_SIZE - 20)
+        roi_label.config(text="")
+    else:
+        roi_label.config(text="Region: drag on the image")
 
-    canvas.config(width=img.shape[1], height=img.shape[0])
-    canvas.image = ImageTk.PhotoImage(image=Image.fromarray(img))
-    canvas.create_image(0, 0, anchor="nw", image=canvas.image)
+        # Update the tkinter window size based on the image size
+        root.geometry()
+
+        canvas.config(width=img.shape[1], height=img.shape[0])
+        canvas.image = ImageTk.PhotoImage(image=Image.fromarray(img))
+        canvas.create_image(0, 0, anchor="nw", image=canvas.image)
     update_image_navigation_buttons()
 
     # Update gilgai and Wheat percentages labels
@@ -65,6 +154,26 @@ def show_image_on_canvas(canvas, image_index):
     wheat_percentage_label.config(text=f"Wheat: {wheat_percentage:.2f}%")
 
 
+def start_region(event):
+    global region_start
+    region_start = (event.x, event.y)
+    image_canvas.delete("region")
+
+
+def drag_region(event):
+    image_canvas.delete("region")
+    image_canvas.create_rectangle(*region_start, event.x, event.y, outline="yellow", width=2, tags="region")
+
+
+def finish_region(event):
+    # Coverage inside the rectangle comes straight from the integral images, nothing is thresholded again
+    if current_integrals is None:
+        return
+
+    wheat, gilgai = rect_coverage(current_integrals, region_start[0], region_start[1], event.x, event.y)[:2]
+    roi_label.config(text=f"Region - Wheat: {wheat:.2f}%  Gilgai: {gilgai:.2f}%")
+
+
 def show_next_image(canvas):
     global current_image_index
     if current_image_index < len(images) - 1:
@@ -93,6 +202,13 @@ custom_font.config(size=14, weight="bold")
 
 current_image_index = 0
 images = []
+current_integrals = None
+region_start = (0, 0)
+run_classes = None
+
+worker_thread = None
+result_queue = queue.Queue()
+cancel_event = threading.Event()
 
 # Define the widgets and layout
 directory_label = Label(root, text="Image Directory:")
@@ -104,8 +220,15 @@ directory_entry.grid(row=0, column=1, padx=10, pady=10)
 browse_button = Button(root, text="Browse", command=lambda: browse_directory(directory_entry))
 browse_button.grid(row=0, column=2, padx=10, pady=10)
 
-process_button = Button(root, text="Process Images", command=lambda: process_directory_gui(directory_entry.get(), json_file_path, output_text))
-process_button.grid(row=1, column=0, columnspan=3, padx=10, pady=10)
+estimate_var = IntVar(value=0)
+process_button = Button(root, text="Process Images", command=lambda: process_directory_gui(directory_entry.get(), json_file_path, output_text, estimate_var.get()))
+process_button.grid(row=1, column=0, padx=10, pady=10)
+
+cancel_button = Button(root, text="Cancel", state="disabled", command=cancel_processing)
+cancel_button.grid(row=1, column=1, padx=10, pady=10)
+
+estimate_checkbutton = Checkbutton(root, text="Fast estimate", variable=estimate_var)
+estimate_checkbutton.grid(row=1, column=2, padx=10, pady=10)
 
 set_threshold_button = Button(root, text="Set Threshold Values", command=lambda: set_threshold_values(json_file_path))
 set_threshold_button.grid(row=2, column=0, columnspan=3, padx=10, pady=10)
@@ -113,6 +236,11 @@ set_threshold_button.grid(row=2, column=0, columnspan=3, padx=10, pady=10)
 image_canvas = Canvas(root, bg="white", width=300, height=300)
 image_canvas.grid(row=3, column=0, columnspan=3, padx=10, pady=10)
 
+# Drag a rectangle on the image to see the coverage inside it
+image_canvas.bind("<ButtonPress-1>", start_region)
+image_canvas.bind("<B1-Motion>", drag_region)
+image_canvas.bind("<ButtonRelease-1>", finish_region)
+
 # Create a frame for buttons and labels
 button_frame = Frame(root)
 button_frame.grid(row=4, column=0, columnspan=3, padx=10, pady=10)
@@ -131,6 +259,12 @@ gilgai_percentage_label.grid(row=1, column=0, padx=(10, 0), pady=(0, 10))
 wheat_percentage_label = Label(button_frame, text="Wheat: -", anchor="w")
 wheat_percentage_label.grid(row=1, column=1, padx=(0, 10), pady=(0, 10))
 
+roi_label = Label(button_frame, text="Region: -", anchor="w")
+roi_label.grid(row=2, column=0, columnspan=2, padx=10, pady=(0, 10))
+
+progress_bar = ttk.Progressbar(root, orient="horizontal", mode="determinate")
+progress_bar.grid(row=5, column=0, columnspan=3, padx=10, pady=(0, 10), sticky="ew")
+
 output_text_label = Label(root, text="CSV Output", anchor="w")
 output_text_label.grid(row=6, column=0, padx=(0, 10), pady=(0, 10))
 output_text = Text(root, wrap="none", width=80, height=15)
@@ -0,0 +1,76 @@
+import os
+import sys
+import json
+import time
+
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is left out of the report there
+    resource = None
+
+STAGES = ("read", "decode", "convert", "store", "mask", "count", "overlay")
+
+
+@contextmanager
+def timed(timings, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def peak_rss_mb(children=False):
+    if resource is None:
+        return None
+
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024
+
+
+def report_path(output_csv_path):
+    return os.path.splitext(output_csv_path)[0] + "_report.json"
+
+
+def new_report(image_directory, output_csv_path, options):
+    return {"image_directory": image_directory, "output_csv": output_csv_path,
+            "options": {key: value for key, value in options.items() if key != "progress"},
+            "started": time.time(), "images": 0, "cached": 0, "bytes_read": 0,
+            "stage_seconds": dict.fromkeys(STAGES, 0.0), "per_image": []}
+
+
+def add_to_report(report, result):
+    timings = result.get("timings", {})
+    report["images"] += 1
+    report["cached"] += "timings" not in result
+    report["bytes_read"] += result.get("bytes", 0)
+    for stage, seconds in timings.items():
+        report["stage_seconds"][stage] = report["stage_seconds"].get(stage, 0.0) + seconds
+
+    report["per_image"].append({"file_name": result["file_name"], "bytes": result.get("bytes"),
+                                "cached": "timings" not in result, "timings": timings,
+                                "peak_rss_mb": result.get("peak_rss_mb")})
+
+
+def finish_report(report):
+    wall_seconds = time.time() - report["started"]
+    busy_seconds = sum(report["stage_seconds"].values())
+    read_seconds = report["stage_seconds"].get("read", 0.0)
+
+    # Share of the work spent waiting on files, a high share points at the disk or network share, not the CPU
+    report.update({"wall_seconds": wall_seconds,
+                   "images_per_second": report["images"] / wall_seconds if wall_seconds else None,
+                   "read_share": read_seconds / busy_seconds if busy_seconds else None,
+                   "read_mb_per_second": report["bytes_read"] / 2 ** 20 / read_seconds if read_seconds else None,
+                   "peak_rss_mb": peak_rss_mb(), "peak_worker_rss_mb": peak_rss_mb(children=True)})
+
+    return report
+
+
+def write_report(report, path):
+    with open(path, "w") as json_file:
+        json.dump(report, json_file, indent=2)
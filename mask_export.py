@@ -0,0 +1,93 @@
+import os
+import cv2
+import queue
+import threading
+import numpy as np
+
+# "png" is a single-channel PNG holding the label of every pixel (one bit per class, as in color_lut),
+# "bits" keeps only n_classes bits per pixel in a .npz and "rle" stores runs of equal labels in a .npz
+MASK_ENCODINGS = {"png": ".png", "bits": ".npz", "rle": ".npz"}
+
+
+def save_labels(path, labels, n_classes, encoding="png"):
+    if encoding == "png":
+        cv2.imwrite(path, labels, [cv2.IMWRITE_PNG_COMPRESSION, 3])
+    elif encoding == "bits":
+        planes = np.stack([(labels >> bit) & 1 for bit in range(n_classes)], axis=-1).astype(np.uint8)
+        np.savez(path, bits=np.packbits(planes), shape=labels.shape, n_classes=n_classes)
+    elif encoding == "rle":
+        flat = labels.ravel()
+        starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+        lengths = np.diff(np.append(starts, flat.size))
+        np.savez_compressed(path, values=flat[starts], lengths=lengths.astype(np.uint32), shape=labels.shape)
+    else:
+        raise ValueError(f"Unknown mask encoding {encoding}, use one of {', '.join(MASK_ENCODINGS)}.")
+
+
+def load_labels(path):
+    if path.lower().endswith(".png"):
+        return cv2.imread(path, cv2.IMREAD_UNCHANGED)
+
+    with np.load(path) as data:
+        shape = tuple(data["shape"])
+        if "bits" in data:
+            n_classes = int(data["n_classes"])
+            planes = np.unpackbits(data["bits"], count=shape[0] * shape[1] * n_classes).reshape(*shape, n_classes)
+            dtype = np.uint8 if n_classes <= 8 else np.uint16
+            return (planes.astype(dtype) << np.arange(n_classes, dtype=dtype)).sum(axis=-1, dtype=dtype)
+
+        return np.repeat(data["values"], data["lengths"]).reshape(shape)
+
+
+def export_path(directory, file_name, extension):
+    path = os.path.join(directory, os.path.splitext(file_name)[0] + extension)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    return path
+
+
+class ExportWriter:
+    # Encodes and writes masks, overlays and integral images on background threads, so classification never waits on PNG/JPEG
+    # encoding. The queue is bounded, so if writing falls behind the producer is slowed rather than memory growing.
+
+    def __init__(self, mask_directory=None, mask_encoding="png", overlay_directory=None, integral_directory=None,
+                 threads=1, queue_size=8):
+        self.mask_directory = mask_directory
+        self.mask_encoding = mask_encoding
+        self.overlay_directory = overlay_directory
+        self.integral_directory = integral_directory
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.errors = []
+        self.threads = [threading.Thread(target=self._write, daemon=True) for _ in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, result, n_classes):
+        if self.mask_directory is not None:
+            self.jobs.put((save_labels, export_path(self.mask_directory, result["file_name"],
+                                                    MASK_ENCODINGS[self.mask_encoding]),
+                           result["labels"], n_classes, self.mask_encoding))
+        if self.overlay_directory is not None:
+            self.jobs.put((cv2.imwrite, export_path(self.overlay_directory, result["file_name"], ".jpg"),
+                           cv2.cvtColor(result["image"], cv2.COLOR_RGB2BGR)))
+        if self.integral_directory is not None:
+            self.jobs.put((np.save, export_path(self.integral_directory, result["file_name"], ".npy"),
+                           result["integrals"]))
+
+    def _write(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                job[0](*job[1:])
+            except Exception as error:
+                self.errors.append(error)
+
+    def close(self):
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
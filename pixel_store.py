@@ -0,0 +1,151 @@
+import os
+import cv2
+import json
+import time
+import sqlite3
+import threading
+import numpy as np
+
+from functools import lru_cache
+
+from color_lut import convert
+from result_cache import file_key
+from instrumentation import timed
+
+# Forms an image can be stored in, "packed" is the 32-bit colour index per pixel that the lookup tables take, so
+# process_directory can classify straight from the store without decoding or converting anything
+LAYOUTS = ("BGR", "HSV", "LAB", "packed")
+
+# Default size cap, least recently used images are removed to stay under it
+MAX_GB = 20
+
+# last_used is only written when it is older than this, so reading from the store doesn't write to the index
+TOUCH_SECONDS = 3600
+
+
+class PixelStore:
+    # Decoded images kept as raw pixels one after another in pixels.bin, with their offsets, shapes and the size and
+    # modification time of the source file in index.sqlite. Reading an image back is a memory map of its bytes, with
+    # no decoding or copying. Writes hold an exclusive lock on the index, so several processes can share one store.
+
+    def __init__(self, store_directory, max_gb=MAX_GB):
+        os.makedirs(store_directory, exist_ok=True)
+        self.data_path = os.path.join(store_directory, "pixels.bin")
+        self.max_bytes = int(max_gb * 2 ** 30)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(store_directory, "index.sqlite"), timeout=60,
+                                          isolation_level=None, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries ("
+                                "name TEXT, layout TEXT, offset INTEGER, nbytes INTEGER, dtype TEXT, shape TEXT, "
+                                "source_size INTEGER, source_mtime_ns INTEGER, last_used REAL, "
+                                "PRIMARY KEY (name, layout))")
+        open(self.data_path, "ab").close()
+
+    def get(self, name, layout="BGR", source_key=None):
+        # None if the image isn't stored, or the source has changed since it was
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                row = self.connection.execute("SELECT offset, nbytes, dtype, shape, source_size, source_mtime_ns, "
+                                              "last_used FROM entries WHERE name = ? AND layout = ?",
+                                              (name, layout)).fetchone()
+                if row is None or (source_key is not None and tuple(row[4:6]) != tuple(source_key)):
+                    return None
+
+                pixels = np.memmap(self.data_path, dtype=row[2], mode="r", offset=row[0],
+                                   shape=tuple(json.loads(row[3])))
+                if time.time() - row[6] > TOUCH_SECONDS:
+                    self.connection.execute("UPDATE entries SET last_used = ? WHERE name = ? AND layout = ?",
+                                            (time.time(), name, layout))
+            finally:
+                self.connection.execute("COMMIT")
+
+        return pixels
+
+    def put(self, name, pixels, layout="BGR", source_key=(0, 0)):
+        pixels = np.ascontiguousarray(pixels)
+        with self.lock:
+            self.connection.execute("BEGIN EXCLUSIVE")
+            try:
+                # An older copy becomes dead space, it is reclaimed the next time the store is compacted
+                self.connection.execute("DELETE FROM entries WHERE name = ? AND layout = ?", (name, layout))
+                if pixels.nbytes <= self.max_bytes:
+                    self._make_room(pixels.nbytes)
+                    with open(self.data_path, "ab") as data_file:
+                        offset = data_file.tell()
+                        data_file.write(pixels.data)
+                    self.connection.execute("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                            (name, layout, offset, pixels.nbytes, pixels.dtype.str,
+                                             json.dumps(pixels.shape), *source_key, time.time()))
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def _make_room(self, nbytes):
+        if os.path.getsize(self.data_path) + nbytes <= self.max_bytes:
+            return
+
+        # Remove the least recently used images until there is space with some to spare, then compact the file
+        live = self.connection.execute("SELECT COALESCE(SUM(nbytes), 0) FROM entries").fetchone()[0]
+        target = 0.9 * self.max_bytes - nbytes
+        for name, layout, size in self.connection.execute("SELECT name, layout, nbytes FROM entries "
+                                                          "ORDER BY last_used").fetchall():
+            if live <= target:
+                break
+            self.connection.execute("DELETE FROM entries WHERE name = ? AND layout = ?", (name, layout))
+            live -= size
+
+        # Committed on its own, so the index always matches the file that is in place
+        self._compact()
+        self.connection.execute("COMMIT")
+        self.connection.execute("BEGIN EXCLUSIVE")
+
+    def _compact(self):
+        # Copies the remaining images into a new file, processes that already mapped the old one keep reading it
+        compact_path = f"{self.data_path}.compact"
+        offset = 0
+        with open(self.data_path, "rb") as old_file, open(compact_path, "wb") as new_file:
+            for name, layout, old_offset, nbytes in self.connection.execute(
+                    "SELECT name, layout, offset, nbytes FROM entries ORDER BY offset").fetchall():
+                old_file.seek(old_offset)
+                new_file.write(old_file.read(nbytes))
+                self.connection.execute("UPDATE entries SET offset = ? WHERE name = ? AND layout = ?",
+                                        (offset, name, layout))
+                offset += nbytes
+        os.replace(compact_path, self.data_path)
+
+    def load(self, img_path, layout="BGR", timings=None):
+        # Pixels of an image file in the given layout, decoded and added to the store the first time. The stages are
+        # timed apart as in process_image(), so a cold run isn't mistaken for a slow disk.
+        timings = {} if timings is None else timings
+        name = os.path.abspath(img_path)
+        with timed(timings, "read"):
+            source_key = file_key(img_path)[:2]
+            pixels = self.get(name, layout, source_key)
+        if pixels is not None:
+            return pixels
+
+        with timed(timings, "read"):
+            with open(img_path, "rb") as img_file:
+                file_bytes = np.frombuffer(img_file.read(), np.uint8)
+        with timed(timings, "decode"):
+            img = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError(f"Could not decode {img_path}.")
+        with timed(timings, "convert"):
+            pixels = convert(img, layout)
+        with timed(timings, "store"):
+            self.put(name, pixels, layout, source_key)
+
+        return pixels
+
+    def close(self):
+        self.connection.close()
+
+
+@lru_cache(maxsize=4)
+def open_store(store_directory, max_gb=MAX_GB):
+    # One store per process, so worker processes keep their index connection between images
+    return PixelStore(store_directory, max_gb)
+
@@ -1,74 +1,453 @@
 import os
 import cv2
 import csv
+import zlib
+import argparse
 import numpy as np
 
+from collections import deque
+from functools import partial
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
 from gilgai_detection import load_slider_values
+from color_lut import (CLASS_COLORS, classes_from_parameters, class_mask, get_lut, seed_lut, uses_lut, convert,
+                       label_image, label_counts, class_masks, masks_to_labels, classify_counts)
+from tiled import tile_coverage
+from estimate import estimate_coverage
+from mask_export import ExportWriter, MASK_ENCODINGS
+from coverage_grid import label_integrals, grid_coverage
+from instrumentation import timed, peak_rss_mb, new_report, add_to_report, finish_report, report_path, write_report
+from pixel_store import MAX_GB, open_store
+from result_cache import open_cache, params_hash, file_key, lookup, store, prune
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff")
+
+# Column names for the classes saved by gilgai_detection.py, any extra classes use their own name
+CLASS_LABELS = {"Green": "Wheat", "Gilgai": "Gilgai"}
+
+
+def list_images(image_directory, recursive=False):
+    # Sorted so that serial and parallel runs produce rows in the same order
+    if recursive:
+        return sorted(scan_images(image_directory))
+
+    return sorted(file_name for file_name in os.listdir(image_directory)
+                  if file_name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def scan_images(image_directory, prefix=""):
+    # Paths relative to image_directory, always with "/" so the same tree gives the same names on every machine
+    file_names = []
+    with os.scandir(os.path.join(image_directory, prefix)) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                file_names += scan_images(image_directory, f"{prefix}{entry.name}/")
+            elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                file_names.append(f"{prefix}{entry.name}")
+
+    return file_names
+
+
+def in_shard(file_name, index, count):
+    # Files are assigned by a hash of their name, so adding files never moves existing ones to another shard
+    return zlib.crc32(file_name.encode()) % count == index
+
+
+def render_overlay(img, labels, n_classes):
+    alpha = 0.5
+    img_with_classes = img
+    for bit in range(n_classes):
+        # Create a colored mask for the class
+        colored_mask = np.zeros_like(img)
+        colored_mask[class_mask(labels, bit) > 0] = CLASS_COLORS[bit % len(CLASS_COLORS)]
+
+        # Overlay masks with 50% transparency
+        if bit == 0:
+            img_with_classes = cv2.addWeighted(colored_mask, alpha, img, 1 - alpha, 0)
+        else:
+            img_with_classes = cv2.addWeighted(colored_mask, alpha, img_with_classes, 1, 0)
+
+    # Convert to RGB for Tkinter
+    return cv2.cvtColor(img_with_classes, cv2.COLOR_BGR2RGB)
+
+
+def image_result(img_path, classes, percentages):
+    percentages = dict(zip((name for name, _, _ in classes), percentages))
+
+    return {"file_name": os.path.basename(img_path), "path": img_path, "percentages": percentages,
+            "green_percentage": percentages.get("Green"), "gilgai_percentage": percentages.get("Gilgai")}
+
+
+def process_image(img_path, classes, overlay=False, tile_size=None, estimate=None, keep_labels=False, grid=None,
+                  keep_integrals=False, pixel_store=None):
+    timings = {}
+
+    # A quick estimate from a reduced decode and a sample of pixels, see estimate_coverage() for the options
+    if estimate is not None:
+        with timed(timings, "estimate"):
+            percentages, intervals, samples = estimate_coverage(img_path, classes, **estimate)
+        result = image_result(img_path, classes, percentages)
+        result.update({"intervals": dict(zip(result["percentages"], intervals)), "samples": samples,
+                       "timings": timings, "peak_rss_mb": peak_rss_mb()})
+        return result
+
+    # Very large images are read and classified one tile at a time, an overlay can't be built for these
+    if tile_size is not None:
+        with timed(timings, "tiled"):
+            percentages, _ = tile_coverage(img_path, classes, tile_size)
+        result = image_result(img_path, classes, percentages)
+        result.update({"timings": timings, "peak_rss_mb": peak_rss_mb()})
+        return result
+
+    # Many classes are labelled in one lookup-table pass over packed colour indices, a few are thresholded with
+    # inRange on the converted image (see INRANGE_CLASSES)
+    layout = "packed" if uses_lut(classes) else "HSV"
+    need_labels = overlay or keep_labels or grid is not None or keep_integrals
+
+    # Pixels decoded by an earlier run are memory-mapped from the store, see PixelStore for the options
+    if pixel_store is not None:
+        store = open_store(**pixel_store)
+        pixels = store.load(img_path, layout, timings)
+        img = store.load(img_path, "BGR", timings) if overlay else None
+        n_bytes = pixels.nbytes
+    else:
+        # Reading the file and decoding it are timed apart, to tell a slow disk or network share from a slow CPU
+        with timed(timings, "read"):
+            with open(img_path, "rb") as img_file:
+                file_bytes = np.frombuffer(img_file.read(), np.uint8)
+        with timed(timings, "decode"):
+            img = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError(f"Could not decode {img_path}.")
+        with timed(timings, "convert"):
+            pixels = convert(img, layout)
+        n_bytes = file_bytes.size
+
+    if layout == "packed":
+        with timed(timings, "mask"):
+            labels = label_image(img, get_lut(classes), pixels)
+        with timed(timings, "count"):
+            counts = label_counts(labels, len(classes))
+    else:
+        with timed(timings, "mask"):
+            masks = class_masks(pixels, classes)
+            labels = masks_to_labels(masks) if need_labels else None
+        with timed(timings, "count"):
+            counts = [cv2.countNonZero(mask) for mask in masks]
+    percentages = [count / (pixels.shape[0] * pixels.shape[1]) * 100 for count in counts]
+
+    result = image_result(img_path, classes, percentages)
+
+    # The full-resolution overlay and labels are only kept when asked for, see load_overlay() for rendering it later
+    if overlay:
+        with timed(timings, "overlay"):
+            result["image"] = render_overlay(img, labels, len(classes))
+    if keep_labels:
+        result["labels"] = labels
+
+    # Integral images let the coverage of any rectangle be looked up without thresholding again
+    if grid is not None or keep_integrals:
+        with timed(timings, "integral"):
+            integrals = label_integrals(labels, len(classes))
+        if grid is not None:
+            result["grid"] = grid_coverage(integrals, *grid)
+        if keep_integrals:
+            result["integrals"] = integrals
+
+    result.update({"bytes": n_bytes, "timings": timings, "peak_rss_mb": peak_rss_mb()})
+    return result
+
+
+def load_overlay(img_path, json_file_path="parameters.json", max_size=None, integrals=False, classes=None):
+    # Pass the classes a run used so the overlay matches its results, even if parameters.json has changed since
+    if classes is None:
+        parameters = load_slider_values(json_file_path)
+        if parameters is None:
+            return None
+        classes = classes_from_parameters(parameters)
+
+    if max_size is None:
+        result = process_image(img_path, classes, overlay=True, keep_integrals=integrals)
+        return (result["image"], result["integrals"]) if integrals else result["image"]
+
+    # Shrink before classifying so only a thumbnail-sized overlay is ever built
+    img = cv2.imread(img_path)
+    if img is None:
+        raise ValueError(f"Could not read {img_path}.")
+    scale = max_size / max(img.shape[:2])
+    if scale < 1:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    labels, _ = classify_counts(img, classes)
+    overlay = render_overlay(img, labels, len(classes))
+
+    # Integral images of the thumbnail let a front-end show coverage of any region without thresholding again
+    if integrals:
+        return overlay, label_integrals(labels, len(classes))
+
+    return overlay
+
+
+def csv_header(classes, intervals=False):
+    header = ["Image Name"] + [f"{CLASS_LABELS.get(name, name)} (%)" for name, _, _ in classes]
+    if intervals:
+        for name, _, _ in classes:
+            header += [f"{CLASS_LABELS.get(name, name)} low (%)", f"{CLASS_LABELS.get(name, name)} high (%)"]
+
+    return header
+
 
-def process_directory(image_directory, json_file_path="parameters.json", output_csv_path="output.csv"):
+def csv_row(result):
+    row = [result["file_name"]] + list(result["percentages"].values())
+    for low, high in result.get("intervals", {}).values():
+        row += [low, high]
+
+    return row
+
+
+def check_options(overlay=False, tile_size=None, estimate=None, mask_directory=None, overlay_directory=None, grid=None,
+                  integral_directory=None, **options):
+    # Estimates and tiled images never hold the label of every pixel at once, so nothing can be made from them
+    if estimate is None and tile_size is None:
+        return
+    if overlay or overlay_directory is not None:
+        raise ValueError("Overlays can't be made with an estimate or a tile size.")
+    if mask_directory is not None:
+        raise ValueError("Masks can't be saved with an estimate or a tile size.")
+    if grid is not None or integral_directory is not None:
+        raise ValueError("Grid coverage and integral images can't be made with an estimate or a tile size.")
+
+
+def _ordered_map(pool, fn, items, window, cached=None):
+    # Like pool.map(), but only keeps `window` images in flight so memory does not grow with the directory.
+    # Items with a cached result skip the pool but still come out in order.
+    pending = deque()
+    for item in items:
+        result = cached(item) if cached is not None else None
+        if result is not None:
+            pending.append(Future())
+            pending[-1].set_result(result)
+        else:
+            pending.append(pool.submit(fn, item))
+
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def _skip_errors(img_path, worker):
+    # Files that can't be read or decoded come back as a result holding the error, see iter_directory(skip_errors)
+    try:
+        return worker(img_path)
+    except (ValueError, OSError, cv2.error) as error:
+        return {"path": img_path, "error": str(error)}
+
+
+def iter_directory(image_directory, parameters, workers=1, executor="process", overlay=False, tile_size=None,
+                   cache_path=None, hash_contents=False, estimate=None, progress=None, recursive=False, shard=None,
+                   file_names=None, mask_directory=None, mask_encoding="png", overlay_directory=None, grid=None,
+                   integral_directory=None, pixel_store=None, skip_errors=False):
+    check_options(overlay, tile_size, estimate, mask_directory, overlay_directory, grid, integral_directory)
+    classes = classes_from_parameters(parameters)
+
+    # Masks, overlays and integral images are only made when they are going to be saved, and written on
+    # background threads
+    writer = None
+    if mask_directory is not None or overlay_directory is not None or integral_directory is not None:
+        writer = ExportWriter(mask_directory, mask_encoding, overlay_directory, integral_directory)
+    worker = partial(process_image, classes=classes, overlay=overlay or overlay_directory is not None,
+                     tile_size=tile_size, estimate=estimate, keep_labels=mask_directory is not None, grid=grid,
+                     keep_integrals=integral_directory is not None, pixel_store=pixel_store)
+    # With skip_errors an image that can't be decoded is reported and left out, instead of stopping the run
+    if skip_errors:
+        worker = partial(_skip_errors, worker=worker)
+
+    # An explicit list of file names (relative to image_directory) can be given instead of listing the directory,
+    # and a (index, count) shard keeps only this node's share of them
+    if file_names is None:
+        file_names = list_images(image_directory, recursive)
+    if shard is not None:
+        file_names = [file_name for file_name in file_names if in_shard(file_name, *shard)]
+    img_paths = (os.path.join(image_directory, file_name) for file_name in file_names)
+
+    # Results already in the cache for this file and these thresholds are returned without decoding the image.
+    # Estimates are never cached, they would be mistaken for exact results, and exports and grid coverage need every
+    # image decoded (the cache only keeps the percentages).
+    cache = None
+    if cache_path is not None and estimate is None and writer is None and grid is None:
+        cache = open_cache(cache_path)
+    classes_hash = params_hash(classes)
+    file_keys = {}
+
+    def cached(img_path):
+        # A cached result has no overlay, so those images are always processed
+        if cache is None or overlay:
+            return None
+
+        file_keys[img_path] = file_key(img_path, hash_contents)
+        percentages = lookup(cache, img_path, file_keys[img_path], classes_hash)
+        if percentages is None:
+            return None
+
+        del file_keys[img_path]
+        return image_result(img_path, classes, percentages)
+
+    # Iterate through all images in the directory, optionally spread across a pool of workers.
+    # Results are yielded in submission order, so they match the serial path exactly.
+    if workers is not None and workers <= 1:
+        results = (cached(img_path) or worker(img_path) for img_path in img_paths)
+    else:
+        workers = workers or os.cpu_count()
+        if executor == "thread":
+            pool = ThreadPoolExecutor(max_workers=workers)
+        elif uses_lut(classes):
+            # The table is compiled once here and handed to each worker, instead of every worker compiling its own
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=seed_lut,
+                                       initargs=(classes, "HSV", get_lut(classes)))
+        else:
+            pool = ProcessPoolExecutor(max_workers=workers)
+        results = _ordered_map(pool, worker, img_paths, window=2 * workers, cached=cached)
+
+    try:
+        for done, (file_name, result) in enumerate(zip(file_names, results), start=1):
+            if "error" in result:
+                file_keys.pop(result["path"], None)
+                print(f"Skipped {file_name}: {result['error']}")
+                continue
+
+            # Results are named by their path below image_directory, which tells apart files in nested folders
+            result["file_name"] = file_name
+            if result["path"] in file_keys:
+                store(cache, result["path"], file_keys.pop(result["path"]), classes_hash,
+                      list(result["percentages"].values()))
+                cache.commit()
+
+            if writer is not None:
+                writer.submit(result, len(classes))
+                result.pop("labels", None)
+                result.pop("integrals", None)
+                if not overlay:
+                    result.pop("image", None)
+
+            # Called from this process as each image finishes, even when the work is done in a pool
+            if progress is not None:
+                progress(done, len(file_names), result)
+            yield result
+    finally:
+        if workers is None or workers > 1:
+            pool.shutdown(cancel_futures=True)
+        if cache is not None:
+            prune(cache)
+            cache.close()
+        if writer is not None:
+            writer.close()
+
+
+def grid_csv_path(output_csv_path):
+    return os.path.splitext(output_csv_path)[0] + "_grid.csv"
+
+
+def stream_directory(image_directory, parameters, output_csv_path="output.csv", report=False, **options):
+    # Checked before the CSV is opened, so a bad combination doesn't overwrite the last results
+    check_options(**options)
+    run_report = new_report(image_directory, output_csv_path, options) if report else None
+    classes = classes_from_parameters(parameters)
+
+    # Coverage of each grid cell goes in a second CSV with one row per cell
+    grid_file = open(grid_csv_path(output_csv_path), "w", newline="") if options.get("grid") else None
+    if grid_file is not None:
+        grid_writer = csv.writer(grid_file)
+        grid_writer.writerow(["Image Name", "Row", "Column"] + csv_header(classes)[1:])
+
+    # Rows are written and flushed as each image finishes, so a crash part way keeps everything done so far
+    try:
+        with open(output_csv_path, "w", newline="") as csv_file:
+            csv_writer = csv.writer(csv_file)
+            csv_writer.writerow(csv_header(classes, options.get("estimate") is not None))
+
+            for result in iter_directory(image_directory, parameters, **options):
+                csv_writer.writerow(csv_row(result))
+                csv_file.flush()
+                if grid_file is not None and "grid" in result:
+                    for row, column in np.ndindex(result["grid"].shape[:2]):
+                        grid_writer.writerow([result["file_name"], row, column] + result["grid"][row, column].tolist())
+                if run_report is not None:
+                    add_to_report(run_report, result)
+                yield result
+    finally:
+        if grid_file is not None:
+            grid_file.close()
+
+    # Timings for every image and stage, saved as JSON next to the CSV
+    if run_report is not None:
+        write_report(finish_report(run_report), report_path(output_csv_path))
+
+
+def print_progress(done, total, result):
+    print(f"{done}/{total} {result['file_name']}")
+
+
+def process_directory(image_directory, json_file_path="parameters.json", output_csv_path="output.csv", **options):
+    # See iter_directory() for the options (workers, executor, overlay, tile_size, cache_path, hash_contents, estimate,
+    # progress, recursive, shard, file_names, mask_directory, mask_encoding, overlay_directory, grid,
+    # integral_directory, pixel_store, skip_errors) and stream_directory() for report
     # Load the slider values from the JSON file
     parameters = load_slider_values(json_file_path)
     if parameters is None:
         print("Error: No JSON file found.")
         return
 
-    green_lower = np.array([parameters[f"Green {color} lower"] for color in ["H", "S", "V"]])
-    green_upper = np.array([parameters[f"Green {color} upper"] for color in ["H", "S", "V"]])
-    gilgai_lower = np.array([parameters[f"Gilgai {color} lower"] for color in ["H", "S", "V"]])
-    gilgai_upper = np.array([parameters[f"Gilgai {color} upper"] for color in ["H", "S", "V"]])
-
-    # Initialize the results list
-    results = []
-
-    # Iterate through all images in the directory
-    for file_name in os.listdir(image_directory):
-        # Check if the file is an image
-        if file_name.lower().endswith((".jpg", ".jpeg", ".png")):
-            img_path = os.path.join(image_directory, file_name)
-
-            # Load and process the image
-            img = cv2.imread(img_path)
-            img_hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-            green_mask = cv2.inRange(img_hsv, green_lower, green_upper)
-            gilgai_mask = cv2.inRange(img_hsv, gilgai_lower, gilgai_upper)
-
-            # Calculate percentages
-            total_pixels = img.shape[0] * img.shape[1]
-            green_percentage = (np.sum(green_mask > 0) / total_pixels) * 100
-            gilgai_percentage = (np.sum(gilgai_mask > 0) / total_pixels) * 100
-
-            # Create green and red colored masks
-            green_colored_mask = cv2.cvtColor(green_mask, cv2.COLOR_GRAY2BGR)
-            red_colored_mask = cv2.cvtColor(gilgai_mask, cv2.COLOR_GRAY2BGR)
-            green_colored_mask[:, :, 0] = 0
-            green_colored_mask[:, :, 2] = 0
-            red_colored_mask[:, :, 0] = 0
-            red_colored_mask[:, :, 1] = 0
-
-            # Overlay masks with 50% transparency
-            green_overlay = cv2.bitwise_and(img, img, mask=green_mask)
-            gilgai_overlay = cv2.bitwise_and(img, img, mask=gilgai_mask)
-            alpha = 0.5
-            img_with_green = cv2.addWeighted(green_colored_mask, alpha, img, 1 - alpha, 0)
-            img_with_gilgai = cv2.addWeighted(red_colored_mask, alpha, img_with_green, 1, 0)
-
-            # Convert to RGB for Tkinter
-            img_with_gilgai_rgb = cv2.cvtColor(img_with_gilgai, cv2.COLOR_BGR2RGB)
-
-            # Add the result to the results list
-            results.append(
-                {"file_name": file_name, "green_percentage": green_percentage, "gilgai_percentage": gilgai_percentage,
-                 "image": img_with_gilgai_rgb})
-
-    # Save the results to a CSV file
-    with open(output_csv_path, "w", newline="") as csv_file:
-        csv_writer = csv.writer(csv_file)
-        csv_writer.writerow(["Image Name", "Wheat (%)", "Gilgai (%)"])
-
-        for result in results:
-            csv_writer.writerow(result)
-
-    return results
+    return list(stream_directory(image_directory, parameters, output_csv_path, **options))
+
 
 if __name__ == "__main__":
-    process_directory(image_directory="images")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Calculate wheat and gilgai coverage for a directory of images.")
+    parser.add_argument("image_directory", nargs="?", default="images")
+    parser.add_argument("--parameters", default="parameters.json", help="threshold values saved by gilgai_detection.py")
+    parser.add_argument("--output", default="output.csv")
+    parser.add_argument("--workers", type=int, default=1, help="number of parallel workers (0 = one per core)")
+    parser.add_argument("--executor", choices=["process", "thread"], default="process")
+    parser.add_argument("--tile-size", type=int, help="classify each image in tiles of this many pixels a side")
+    parser.add_argument("--cache", help="SQLite file of previous results, unchanged images are not processed again")
+    parser.add_argument("--cache-hash", action="store_true", help="also compare file contents, not just size and time")
+    parser.add_argument("--estimate", type=int, choices=[1, 2, 4, 8],
+                        help="quick estimate from an image decoded at 1/N of its size, with confidence intervals")
+    parser.add_argument("--tolerance", type=float, help="with --estimate, stop sampling pixels once every interval "
+                                                        "is within +/- this many percentage points")
+    parser.add_argument("--sample-size", type=int, help="with --estimate, the most pixels to classify per image")
+    parser.add_argument("--recursive", action="store_true", help="also process images in sub-directories")
+    parser.add_argument("--masks", help="save the class of every pixel for each image to this directory")
+    parser.add_argument("--mask-encoding", choices=list(MASK_ENCODINGS), default="png",
+                        help="label PNG, bit-packed .npz or run-length encoded .npz")
+    parser.add_argument("--overlays", help="save an overlay JPEG for each image to this directory")
+    parser.add_argument("--grid", type=int, nargs=2, metavar=("ROWS", "COLUMNS"),
+                        help="also save the coverage of each cell of a grid over every image to <output>_grid.csv")
+    parser.add_argument("--integrals", help="save per-class integral images to this directory for region queries")
+    parser.add_argument("--pixel-store", help="keep decoded pixels in this directory, later runs read them without "
+                                              "decoding")
+    parser.add_argument("--pixel-store-gb", type=float, default=MAX_GB, help="largest size of the pixel store on disk")
+    parser.add_argument("--report", action="store_true", help="save per-image and per-stage timings as JSON "
+                                                              "next to the CSV")
+    args = parser.parse_args()
+
+    estimate = None
+    if args.estimate is not None:
+        estimate = {"reduction": args.estimate, "tolerance": args.tolerance, "sample_size": args.sample_size}
+    pixel_store = None
+    if args.pixel_store is not None:
+        pixel_store = {"store_directory": args.pixel_store, "max_gb": args.pixel_store_gb}
+
+    try:
+        check_options(tile_size=args.tile_size, estimate=estimate, mask_directory=args.masks,
+                      overlay_directory=args.overlays, grid=args.grid, integral_directory=args.integrals)
+    except ValueError as error:
+        parser.error(str(error))
+
+    process_directory(args.image_directory, args.parameters, args.output,
+                      workers=args.workers or None, executor=args.executor, tile_size=args.tile_size,
+                      cache_path=args.cache, hash_contents=args.cache_hash, estimate=estimate, report=args.report,
+                      recursive=args.recursive, mask_directory=args.masks, mask_encoding=args.mask_encoding,
+                      overlay_directory=args.overlays, grid=args.grid, integral_directory=args.integrals,
+                      pixel_store=pixel_store, progress=print_progress)
@@ -0,0 +1,69 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+# Entries that haven't been used for this long are removed when the cache is pruned
+MAX_AGE_DAYS = 30
+
+
+def open_cache(cache_path):
+    connection = sqlite3.connect(cache_path)
+    connection.execute("CREATE TABLE IF NOT EXISTS results ("
+                       "path TEXT, params_hash TEXT, size INTEGER, mtime_ns INTEGER, content_hash TEXT, "
+                       "percentages TEXT, last_used REAL, PRIMARY KEY (path, params_hash))")
+
+    return connection
+
+
+def params_hash(classes):
+    return hashlib.sha256(json.dumps(classes).encode()).hexdigest()
+
+
+def content_hash(img_path):
+    digest = hashlib.sha1()
+    with open(img_path, "rb") as img_file:
+        for chunk in iter(lambda: img_file.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def file_key(img_path, hash_contents=False):
+    # Size and modification time catch nearly every change, hashing the contents also catches in-place rewrites
+    stat = os.stat(img_path)
+    return stat.st_size, stat.st_mtime_ns, content_hash(img_path) if hash_contents else None
+
+
+def lookup(connection, img_path, key, classes_hash):
+    row = connection.execute("SELECT size, mtime_ns, content_hash, percentages FROM results "
+                             "WHERE path = ? AND params_hash = ?", (os.path.abspath(img_path), classes_hash)).fetchone()
+    if row is None:
+        return None
+
+    # The file changed since it was cached, so the stored result is evicted
+    size, mtime_ns, stored_hash, percentages = row
+    if (size, mtime_ns) != key[:2] or (key[2] is not None and stored_hash != key[2]):
+        connection.execute("DELETE FROM results WHERE path = ? AND params_hash = ?",
+                           (os.path.abspath(img_path), classes_hash))
+        return None
+
+    connection.execute("UPDATE results SET last_used = ? WHERE path = ? AND params_hash = ?",
+                       (time.time(), os.path.abspath(img_path), classes_hash))
+    return json.loads(percentages)
+
+
+def store(connection, img_path, key, classes_hash, percentages):
+    connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (os.path.abspath(img_path), classes_hash, key[0], key[1], key[2],
+                        json.dumps(percentages), time.time()))
+
+
+def prune(connection, max_age_days=MAX_AGE_DAYS):
+    # Remove results for files that no longer exist and for thresholds that haven't been used in a while
+    missing = [(path,) for (path,) in connection.execute("SELECT DISTINCT path FROM results")
+               if not os.path.exists(path)]
+    connection.executemany("DELETE FROM results WHERE path = ?", missing)
+    connection.execute("DELETE FROM results WHERE last_used < ?", (time.time() - max_age_days * 86400,))
+    connection.commit()
@@ -0,0 +1,134 @@
+import os
+import csv
+import glob
+import socket
+import argparse
+
+from datetime import datetime
+
+from gilgai_detection import load_slider_values
+from color_lut import classes_from_parameters
+from process_directory import iter_directory, list_images, csv_header, csv_row, print_progress
+
+# Extra columns saying where and when each row was produced
+PROVENANCE = ["Shard", "Host", "Processed At"]
+
+
+def write_manifest(image_directory, manifest_path):
+    # Every node can work from the same list, even if the archive changes while the shards are running
+    file_names = list_images(image_directory, recursive=True)
+    with open(manifest_path, "w") as manifest_file:
+        manifest_file.writelines(f"{file_name}\n" for file_name in file_names)
+
+    return file_names
+
+
+def read_manifest(manifest_path):
+    with open(manifest_path) as manifest_file:
+        return [line.rstrip("\n") for line in manifest_file if line.strip()]
+
+
+def shard_csv_path(output_directory, index, count):
+    return os.path.join(output_directory, f"shard-{index:04d}-of-{count:04d}.csv")
+
+
+def run_shard(image_directory, index, count, output_directory, json_file_path="parameters.json", manifest_path=None,
+              **options):
+    # Load the slider values from the JSON file
+    parameters = load_slider_values(json_file_path)
+    if parameters is None:
+        print("Error: No JSON file found.")
+        return
+
+    file_names = read_manifest(manifest_path) if manifest_path is not None else None
+    classes = classes_from_parameters(parameters)
+    host = socket.gethostname()
+
+    # The shard is written under a temporary name and only moved into place once it is complete,
+    # so re-running a failed shard replaces its output instead of adding to it
+    output_csv_path = shard_csv_path(output_directory, index, count)
+    partial_path = f"{output_csv_path}.partial"
+    results = []
+    with open(partial_path, "w", newline="") as csv_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(csv_header(classes) + PROVENANCE)
+
+        for result in iter_directory(image_directory, parameters, recursive=True, shard=(index, count),
+                                     file_names=file_names, **options):
+            csv_writer.writerow(csv_row(result) + [f"{index}/{count}", host,
+                                                   datetime.now().isoformat(timespec="seconds")])
+            csv_file.flush()
+            results.append(result)
+
+    os.replace(partial_path, output_csv_path)
+    return results
+
+
+def merge_shards(output_directory, merged_csv_path, manifest_path=None):
+    header = None
+    rows = {}
+    for shard_path in sorted(glob.glob(os.path.join(output_directory, "shard-*-of-*.csv"))):
+        with open(shard_path, newline="") as csv_file:
+            csv_reader = csv.reader(csv_file)
+            shard_header = next(csv_reader)
+            if header is not None and shard_header != header:
+                raise ValueError(f"{shard_path} has different columns to the other shards, "
+                                 f"were they run with different parameters?")
+            header = shard_header
+
+            # One row per image, if an image appears in more than one shard output the newest row is kept
+            for row in csv_reader:
+                if row[0] not in rows or row[-1] >= rows[row[0]][-1]:
+                    rows[row[0]] = row
+
+    if header is None:
+        print("Error: No shard outputs found.")
+        return
+
+    with open(merged_csv_path, "w", newline="") as csv_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(header)
+        csv_writer.writerows(rows[file_name] for file_name in sorted(rows))
+
+    # Anything in the manifest without a row belongs to a shard that hasn't finished
+    missing = []
+    if manifest_path is not None:
+        missing = [file_name for file_name in read_manifest(manifest_path) if file_name not in rows]
+        if missing:
+            print(f"{len(missing)} images in the manifest have no results yet, e.g. {missing[0]}")
+
+    return missing
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split a large, nested image archive across several machines and "
+                                                 "merge the results.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    manifest_parser = subparsers.add_parser("manifest", help="list every image below a directory")
+    manifest_parser.add_argument("image_directory")
+    manifest_parser.add_argument("--manifest", default="manifest.txt")
+
+    run_parser = subparsers.add_parser("run", help="process one shard of the images")
+    run_parser.add_argument("image_directory")
+    run_parser.add_argument("--shard", type=int, nargs=2, metavar=("INDEX", "COUNT"), required=True,
+                            help="process shard INDEX (counting from 0) of COUNT")
+    run_parser.add_argument("--manifest", help="use this list of images instead of scanning the directory")
+    run_parser.add_argument("--parameters", default="parameters.json")
+    run_parser.add_argument("--output-directory", default="shards")
+    run_parser.add_argument("--workers", type=int, default=1, help="number of parallel workers (0 = one per core)")
+
+    merge_parser = subparsers.add_parser("merge", help="combine the shard outputs into one CSV")
+    merge_parser.add_argument("--output-directory", default="shards")
+    merge_parser.add_argument("--output", default="output.csv")
+    merge_parser.add_argument("--manifest", help="report images in the manifest that have no results")
+
+    args = parser.parse_args()
+    if args.command == "manifest":
+        write_manifest(args.image_directory, args.manifest)
+    elif args.command == "run":
+        os.makedirs(args.output_directory, exist_ok=True)
+        run_shard(args.image_directory, *args.shard, args.output_directory, args.parameters, args.manifest,
+                  workers=args.workers or None, progress=print_progress)
+    else:
+        merge_shards(args.output_directory, args.output, args.manifest)
@@ -1,3 +1,6 @@
+import os
+import hashlib
+
 from datetime import datetime
 
 import streamlit as st
@@ -6,6 +9,58 @@ import numpy as np
 import imutils
 import cv2
 
+from color_lut import COLOR_CONVERSIONS, MAX_CLASSES
+from color_index import color_counts, counts_coverage
+from coverage_grid import mask_integrals, rect_coverage
+from pixel_store import MAX_GB, open_store
+
+# Number of decoded images, previews and converted previews kept between reruns, least recently used go first
+CACHE_ENTRIES = 8
+PREVIEW_HEIGHT = 600
+
+# Set GILGAI_PIXEL_STORE to a directory to keep decoded uploads on disk, so the same reference images aren't decoded
+# again after the app restarts or in a new session
+PIXEL_STORE = os.environ.get("GILGAI_PIXEL_STORE")
+PIXEL_STORE_GB = float(os.environ.get("GILGAI_PIXEL_STORE_GB", MAX_GB))
+
+
+def upload_key(uploaded_file):
+    return uploaded_file.name, uploaded_file.size, getattr(uploaded_file, "file_id", None)
+
+
+# The cached arrays are shared between reruns and must not be modified, copy them before drawing on them.
+# Arguments starting with an underscore are not hashed, the upload is identified by its key instead.
+@st.cache_resource(max_entries=CACHE_ENTRIES)
+def decode_upload(key, _uploaded_file):
+    _uploaded_file.seek(0)
+    file_bytes = np.asarray(bytearray(_uploaded_file.read()), dtype=np.uint8)
+    if PIXEL_STORE is None:
+        return cv2.imdecode(file_bytes, 1)
+
+    # The store is shared by every session, so uploads are known by their contents, not their (often reused) names
+    store = open_store(PIXEL_STORE, PIXEL_STORE_GB)
+    name = f"upload/{hashlib.sha1(file_bytes).hexdigest()}"
+    image = store.get(name, "BGR", (file_bytes.size, 0))
+    if image is None:
+        image = cv2.imdecode(file_bytes, 1)
+        store.put(name, image, "BGR", (file_bytes.size, 0))
+
+    return image
+
+
+@st.cache_resource(max_entries=CACHE_ENTRIES)
+def preview_image(key, _uploaded_file):
+    return imutils.resize(decode_upload(key, _uploaded_file), height=PREVIEW_HEIGHT)
+
+
+@st.cache_resource(max_entries=CACHE_ENTRIES)
+def converted_preview(key, color_space, _uploaded_file):
+    image = preview_image(key, _uploaded_file)
+    if color_space in COLOR_CONVERSIONS:
+        return cv2.cvtColor(image, COLOR_CONVERSIONS[color_space])
+
+    return image
+
 
 def thresholding(image, lower, upper, color_space):
     if color_space == "HSV":
@@ -22,15 +77,25 @@ def thresholding(image, lower, upper, color_space):
     return result, coverage
 
 
-def apply_mask(image, lower, upper, color, color_space, alpha=0.5):
-    if color_space == "HSV":
-        converted_image = cv2.cvtColor(image.copy(), cv2.COLOR_BGR2HSV)
-    elif color_space == "LAB":
-        converted_image = cv2.cvtColor(image.copy(), cv2.COLOR_BGR2Lab)
-    else:
-        converted_image = image.copy()
+@st.cache_resource(max_entries=CACHE_ENTRIES)
+def preview_masks(key, color_space, bounds, _converted_image):
+    # Keyed on the thresholds, so moving the region sliders reuses the masks and only looks up four corners per class
+    masks = [cv2.inRange(_converted_image, np.array(lower), np.array(upper)) for lower, upper in bounds]
+    return masks, mask_integrals(masks)
 
-    mask = cv2.inRange(converted_image, lower, upper)
+
+def apply_mask(image, lower, upper, color, color_space, alpha=0.5, converted_image=None, mask=None):
+    # The mask, or the converted image it is made from, can be passed in when it has already been cached
+    if mask is None:
+        if converted_image is None:
+            if color_space == "HSV":
+                converted_image = cv2.cvtColor(image.copy(), cv2.COLOR_BGR2HSV)
+            elif color_space == "LAB":
+                converted_image = cv2.cvtColor(image.copy(), cv2.COLOR_BGR2Lab)
+            else:
+                converted_image = image.copy()
+
+        mask = cv2.inRange(converted_image, lower, upper)
     colored_mask = np.zeros_like(image)
     colored_mask[mask > 0] = color
 
@@ -64,8 +129,10 @@ def app():
     uploaded_files = st.sidebar.file_uploader("Upload an image", type=["png", "jpg", "jpeg"], accept_multiple_files=True)
     color_space = col2.selectbox("Choose color space", options=["RGB", "HSV", "LAB"])
 
+    n_classes = col2.number_input("Number of classes", min_value=1, max_value=MAX_CLASSES, value=2)
+
     thresholds = {}
-    for i in range(2):
+    for i in range(n_classes):
         # col2.write(f"### Class {i + 1} {color_space} Thresholds")
         lower = []
         upper = []
@@ -81,24 +148,31 @@ def app():
             upper.append(selected_range[1])
         thresholds[f"class_{i + 1}"] = {"lower": np.array(lower), "upper": np.array(upper)}
 
+    # Region of interest as a fraction of the image, its coverage comes from integral images of the masks
+    roi_expander = col2.expander("Region of Interest")
+    roi_x = roi_expander.slider("Left - right (%)", min_value=0, max_value=100, value=(0, 100))
+    roi_y = roi_expander.slider("Top - bottom (%)", min_value=0, max_value=100, value=(0, 100))
+
+    st.sidebar.caption("Saved coverage is calculated from the colour counts of each image, so changing thresholds "
+                       "never needs the images to be decoded again.")
     if st.sidebar.button("Save Results"):
         if uploaded_files:
             results = []
+            # Each upload is decoded once per colour space into the count of every distinct colour, after that any
+            # thresholds are answered exactly from the counts without touching the pixels again
+            color_index = st.session_state.setdefault("color_index", {})
             for uploaded_file in uploaded_files:
-                uploaded_file.seek(0)
-                file_bytes = np.asarray(bytearray(uploaded_file.read()), dtype=np.uint8)
-                image = cv2.imdecode(file_bytes, 1)
-                coverages = []
-                for i in range(2):
-                    _, coverage = thresholding(image, thresholds[f"class_{i + 1}"]["lower"],
-                                               thresholds[f"class_{i + 1}"]["upper"], color_space)
-                    coverages.append(coverage)
-                result = {
-                    "image_name": uploaded_file.name,
-                    "class_1_%": coverages[0],
-                    "class_2_%": coverages[1],
-                }
-                for i in range(2):
+                index_key = (upload_key(uploaded_file), color_space)
+                if index_key not in color_index:
+                    image = decode_upload(upload_key(uploaded_file), uploaded_file)
+                    color_index[index_key] = color_counts(image, color_space)
+
+                result = {"image_name": uploaded_file.name}
+                for i in range(n_classes):
+                    result[f"class_{i + 1}_%"] = float(counts_coverage(*color_index[index_key],
+                                                                       thresholds[f"class_{i + 1}"]["lower"],
+                                                                       thresholds[f"class_{i + 1}"]["upper"]))
+                for i in range(n_classes):
                     for ch, lower_value, upper_value in zip(color_space, thresholds[f"class_{i + 1}"]["lower"],
                                                             thresholds[f"class_{i + 1}"]["upper"]):
                         result[f"lower_{ch}_class_{i + 1}"] = lower_value
@@ -116,21 +190,29 @@ def app():
             st.warning("No images uploaded. Please upload images to save results.")
 
     if uploaded_files:
-        col1_columns = col1.columns(2)
+        col1_columns = col1.columns(n_classes)
 
         current_image_idx = st.session_state.get("current_image_idx", 0)
 
+        # Decoding, resizing and colour conversion are cached, so moving a slider only re-runs the masking
         uploaded_file = uploaded_files[current_image_idx]
-        uploaded_file.seek(0)
-        file_bytes = np.asarray(bytearray(uploaded_file.read()), dtype=np.uint8)
-        image = cv2.imdecode(file_bytes, 1)
-        image = imutils.resize(image.copy(), height=600)
-
-        overlay_image = image.copy()
-        colors = [(200, 43, 104), (0, 0, 255)]  # Red and blue colors for the masks
-        for i in range(2):
+        image = preview_image(upload_key(uploaded_file), uploaded_file)
+        converted_image = converted_preview(upload_key(uploaded_file), color_space, uploaded_file)
+        bounds = tuple((tuple(int(v) for v in thresholds[f"class_{i + 1}"]["lower"]),
+                        tuple(int(v) for v in thresholds[f"class_{i + 1}"]["upper"])) for i in range(n_classes))
+        masks, integrals = preview_masks(upload_key(uploaded_file), color_space, bounds, converted_image)
+
+        height, width = image.shape[:2]
+        roi = (roi_x[0] * width // 100, roi_y[0] * height // 100, roi_x[1] * width // 100, roi_y[1] * height // 100)
+        roi_coverages = rect_coverage(integrals, *roi)
+
+        overlay_image = image
+        colors = [(200, 43, 104), (0, 0, 255), (0, 200, 0), (0, 215, 255),
+                  (255, 0, 255), (255, 255, 0), (255, 255, 255), (0, 128, 255)]  # Colors for each class mask
+        for i in range(n_classes):
             masked_image, mask = apply_mask(overlay_image, thresholds[f"class_{i + 1}"]["lower"],
-                                            thresholds[f"class_{i + 1}"]["upper"], colors[i], color_space, alpha=0.1)
+                                            thresholds[f"class_{i + 1}"]["upper"], colors[i % len(colors)], color_space,
+                                            alpha=0.1, mask=masks[i])
             show_overlay = col1_columns[i].checkbox(f"Class {i + 1} Overlay", value=False, key=f"overlay_class_{i + 1}")
             if show_overlay:
                 overlay_image = masked_image
@@ -139,15 +221,19 @@ def app():
 
             col1_columns[i].write(f"Coverage Class {i + 1}: {coverage:.2f}%")
             col1_columns[i].progress(int(coverage))
+            if roi != (0, 0, width, height):
+                col1_columns[i].write(f"Region Coverage Class {i + 1}: {roi_coverages[i]:.2f}%")
 
-        display_image = cv2.cvtColor(overlay_image.copy(), cv2.COLOR_BGR2RGB)
+        display_image = cv2.cvtColor(overlay_image, cv2.COLOR_BGR2RGB)
+        if roi != (0, 0, width, height):
+            cv2.rectangle(display_image, roi[:2], (max(roi[2] - 1, 0), max(roi[3] - 1, 0)), (255, 255, 0), 2)
         image_placeholder.image(display_image)
 
         if col1_columns[0].button("Back"):
             if current_image_idx > 0:
                 current_image_idx -= 1
                 st.session_state.current_image_idx = current_image_idx
-        if col1_columns[1].button("Next"):
+        if col1_columns[-1].button("Next"):
             if current_image_idx < len(uploaded_files) - 1:
                 current_image_idx += 1
                 st.session_state.current_image_idx = current_image_idx
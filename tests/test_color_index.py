@@ -0,0 +1,32 @@
+import os
+import cv2
+import numpy as np
+
+from color_index import build_index, index_coverage, threshold_sweep, color_counts, counts_coverage, image_histogram, \
+    summed_volume, box_coverage
+from color_lut import classes_from_parameters, classify
+from gilgai_detection import load_slider_values
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES = os.path.join(ROOT, "images")
+
+
+def test_exact_index_matches_classifier():
+    classes = classes_from_parameters(load_slider_values(os.path.join(ROOT, "parameters.json")))
+    for result in index_coverage(build_index(IMAGES, bins=0), classes):
+        _, percentages = classify(cv2.imread(os.path.join(IMAGES, result["file_name"])), classes)
+        assert np.allclose(list(result["percentages"].values()), percentages)
+
+
+def test_histogram_index_is_exact_on_bin_edges():
+    # Boxes that start and end on bin edges (every 5.625 hue, every 8 saturation and value) aren't snapped
+    boxes = [((0, 0, 0), (89, 255, 255)), ((90, 128, 0), (179, 255, 127))]
+    assert np.allclose(threshold_sweep(build_index(IMAGES), boxes), threshold_sweep(build_index(IMAGES, bins=0), boxes))
+
+
+def test_lower_bound_above_channel_range_is_empty():
+    img = cv2.imread(os.path.join(IMAGES, "test1.png"))
+    assert box_coverage(summed_volume(image_histogram(img, "HSV", 32)), (184, 0, 0), (255, 255, 255)) == 0
+    assert counts_coverage(*color_counts(img), (184, 0, 0), (255, 255, 255)) == 0
+    for bins in (0, 32):
+        assert np.all(threshold_sweep(build_index(IMAGES, bins=bins), [((184, 0, 0), (255, 255, 255))]) == 0)
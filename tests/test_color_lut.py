@@ -0,0 +1,31 @@
+import os
+import cv2
+import numpy as np
+
+from color_lut import classes_from_parameters, classify_counts, get_lut, label_image, label_counts, uses_lut
+from gilgai_detection import load_slider_values
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PARAMETERS = os.path.join(ROOT, "parameters.json")
+
+
+def test_inrange_and_table_give_the_same_labels():
+    classes = classes_from_parameters(load_slider_values(PARAMETERS))
+    img = cv2.imread(os.path.join(ROOT, "images", "test1.png"))
+    assert not uses_lut(classes)
+
+    labels, counts = classify_counts(img, classes)
+    lut_labels = label_image(img, get_lut(classes))
+    assert np.array_equal(labels, lut_labels)
+    assert counts == label_counts(lut_labels, len(classes))
+
+
+def test_many_classes_use_the_table():
+    classes = classes_from_parameters(load_slider_values(PARAMETERS)) * 3
+    img = cv2.imread(os.path.join(ROOT, "images", "test2.png"))
+    assert uses_lut(classes)
+
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    _, counts = classify_counts(img, classes)
+    assert counts == [cv2.countNonZero(cv2.inRange(hsv, np.array(lower), np.array(upper)))
+                      for _, lower, upper in classes]
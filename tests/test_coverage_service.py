@@ -0,0 +1,46 @@
+import os
+import json
+import threading
+import urllib.error
+import urllib.request
+import pytest
+
+from http.server import ThreadingHTTPServer
+
+from coverage_service import CoverageService, CoverageHandler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def url():
+    service = CoverageService(os.path.join(ROOT, "parameters.json"), workers=2)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), type("Handler", (CoverageHandler,), {"service": service}))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/coverage"
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+
+def post(url, payload):
+    request = urllib.request.Request(url, json.dumps(payload).encode(), {"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as error:
+        return error.code, json.load(error)
+
+
+def test_paths(url):
+    status, reply = post(url, {"paths": [os.path.join(ROOT, "images", "test1.png")]})
+    assert status == 200
+    assert reply["results"][0]["percentages"]["Gilgai"] == pytest.approx(17.118186724230977)
+
+
+@pytest.mark.parametrize("payload", [{"paths": ["bad.png"]}, {"paths": 5}, {"path": __file__}, [1]])
+def test_bad_requests_get_an_error_reply(url, payload):
+    status, reply = post(url, payload)
+    assert status == 400
+    assert "error" in reply
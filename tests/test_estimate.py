@@ -0,0 +1,28 @@
+import os
+import cv2
+import pytest
+
+from estimate import estimate_coverage
+from color_lut import classes_from_parameters, classify
+from gilgai_detection import load_slider_values
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES = os.path.join(ROOT, "images")
+
+
+@pytest.mark.parametrize("file_name", ["test1.png", "test2.png", "twitter_test.png"])
+@pytest.mark.parametrize("reduction", [2, 4])
+def test_exact_coverage_is_inside_the_interval(file_name, reduction):
+    classes = classes_from_parameters(load_slider_values(os.path.join(ROOT, "parameters.json")))
+    img_path = os.path.join(IMAGES, file_name)
+    _, exact = classify(cv2.imread(img_path), classes, keep_labels=False)
+    _, intervals, _ = estimate_coverage(img_path, classes, reduction=reduction)
+    for value, (low, high) in zip(exact, intervals):
+        assert low <= value <= high
+
+
+def test_full_resolution_interval_closes_up():
+    classes = classes_from_parameters(load_slider_values(os.path.join(ROOT, "parameters.json")))
+    percentages, intervals, _ = estimate_coverage(os.path.join(IMAGES, "test1.png"), classes, reduction=1)
+    for value, (low, high) in zip(percentages, intervals):
+        assert low == pytest.approx(value) and high == pytest.approx(value)
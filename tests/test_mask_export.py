@@ -0,0 +1,38 @@
+import os
+import cv2
+import numpy as np
+import pytest
+
+from mask_export import MASK_ENCODINGS, save_labels, load_labels
+from process_directory import process_directory
+from color_lut import classes_from_parameters, classify
+from gilgai_detection import load_slider_values
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES = os.path.join(ROOT, "images")
+PARAMETERS = os.path.join(ROOT, "parameters.json")
+
+
+@pytest.mark.parametrize("encoding", list(MASK_ENCODINGS))
+@pytest.mark.parametrize("n_classes", [2, 5, 12])
+def test_labels_round_trip(tmp_path, encoding, n_classes):
+    dtype = np.uint8 if n_classes <= 8 else np.uint16
+    labels = np.random.default_rng(n_classes).integers(0, 1 << n_classes, (37, 53)).astype(dtype)
+    labels[10:20] = 0
+
+    path = str(tmp_path / f"labels{MASK_ENCODINGS[encoding]}")
+    save_labels(path, labels, n_classes, encoding)
+    loaded = load_labels(path)
+    assert loaded.dtype == labels.dtype
+    assert np.array_equal(loaded, labels)
+
+
+@pytest.mark.parametrize("encoding", list(MASK_ENCODINGS))
+def test_saved_masks_match_classifier(tmp_path, encoding):
+    classes = classes_from_parameters(load_slider_values(PARAMETERS))
+    process_directory(IMAGES, PARAMETERS, str(tmp_path / "output.csv"), mask_directory=str(tmp_path / "masks"),
+                      mask_encoding=encoding)
+    for file_name in ("test1.png", "test2.png", "twitter_test.png"):
+        labels, _ = classify(cv2.imread(os.path.join(IMAGES, file_name)), classes)
+        mask_path = tmp_path / "masks" / (os.path.splitext(file_name)[0] + MASK_ENCODINGS[encoding])
+        assert np.array_equal(load_labels(str(mask_path)), labels)
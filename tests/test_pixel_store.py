@@ -0,0 +1,52 @@
+import os
+import io
+import cv2
+import shutil
+import numpy as np
+
+import streamlit_app
+from pixel_store import PixelStore
+from process_directory import process_image
+from color_lut import classes_from_parameters
+from gilgai_detection import load_slider_values
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES = os.path.join(ROOT, "images")
+CLASSES = classes_from_parameters(load_slider_values(os.path.join(ROOT, "parameters.json")))
+
+
+class Upload(io.BytesIO):
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name, self.size, self.file_id = name, len(data), name
+
+
+def test_cold_and_warm_runs(tmp_path):
+    store = {"store_directory": str(tmp_path / "store")}
+    img_path = os.path.join(IMAGES, "test1.png")
+    cold = process_image(img_path, CLASSES, pixel_store=store)
+    warm = process_image(img_path, CLASSES, pixel_store=store)
+
+    assert cold["percentages"] == warm["percentages"] == process_image(img_path, CLASSES)["percentages"]
+    assert {"read", "decode", "convert"} <= set(cold["timings"])
+    assert "decode" not in warm["timings"]
+
+
+def test_changed_source_is_decoded_again(tmp_path):
+    img_path = str(tmp_path / "image.png")
+    shutil.copy(os.path.join(IMAGES, "test1.png"), img_path)
+    store = PixelStore(str(tmp_path / "store"))
+    store.load(img_path)
+
+    shutil.copy(os.path.join(IMAGES, "test2.png"), img_path)
+    assert np.array_equal(store.load(img_path), cv2.imread(img_path))
+
+
+def test_uploads_with_the_same_name_and_size(tmp_path, monkeypatch):
+    monkeypatch.setattr(streamlit_app, "PIXEL_STORE", str(tmp_path / "store"))
+    images = [np.full((20, 30, 3), value, np.uint8) for value in (10, 200)]
+    uploads = [Upload("IMG_0001.PNG", cv2.imencode(".bmp", image)[1].tobytes()) for image in images]
+    assert uploads[0].size == uploads[1].size
+
+    for image, upload in zip(images, uploads):
+        assert np.array_equal(streamlit_app.decode_upload.__wrapped__(None, upload), image)
@@ -0,0 +1,54 @@
+import os
+import csv
+import pytest
+
+from process_directory import process_directory, load_overlay
+from color_lut import classes_from_parameters
+from gilgai_detection import load_slider_values
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES = os.path.join(ROOT, "images")
+PARAMETERS = os.path.join(ROOT, "parameters.json")
+
+
+def read_csv(path):
+    with open(path, newline="") as csv_file:
+        return list(csv.reader(csv_file))
+
+
+@pytest.mark.parametrize("options", [{}, {"workers": 2}, {"workers": 2, "executor": "thread"}])
+def test_matches_saved_output(tmp_path, options):
+    process_directory(IMAGES, PARAMETERS, str(tmp_path / "output.csv"), **options)
+    assert read_csv(tmp_path / "output.csv") == read_csv(os.path.join(ROOT, "output.csv"))
+
+
+@pytest.mark.parametrize("options", [{"mask_directory": "masks", "estimate": {"reduction": 4}},
+                                     {"overlay_directory": "overlays", "tile_size": 256},
+                                     {"integral_directory": "integrals", "estimate": {"reduction": 2}},
+                                     {"grid": (2, 2), "tile_size": 256}])
+def test_exports_need_full_labels(tmp_path, options):
+    options = {key: str(tmp_path / value) if key.endswith("_directory") else value for key, value in options.items()}
+    with pytest.raises(ValueError):
+        process_directory(IMAGES, PARAMETERS, str(tmp_path / "output.csv"), **options)
+    assert not os.path.exists(tmp_path / "output.csv")
+
+
+def test_overlay_uses_the_classes_given(tmp_path):
+    classes = classes_from_parameters(load_slider_values(PARAMETERS))
+    img_path = os.path.join(IMAGES, "test1.png")
+    _, integrals = load_overlay(img_path, str(tmp_path / "missing.json"), max_size=100, integrals=True,
+                                classes=classes)
+    assert integrals.shape[0] == len(classes)
+
+
+def test_overlay_of_unreadable_image(tmp_path):
+    (tmp_path / "broken.png").write_bytes(b"not an image")
+    with pytest.raises(ValueError):
+        load_overlay(str(tmp_path / "broken.png"), PARAMETERS, max_size=100)
+
+
+def test_cached_run_still_writes_grid(tmp_path):
+    for _ in range(2):
+        process_directory(IMAGES, PARAMETERS, str(tmp_path / "output.csv"), cache_path=str(tmp_path / "cache.sqlite"),
+                          grid=(2, 3))
+        assert len(read_csv(tmp_path / "output_grid.csv")) == 1 + 3 * 2 * 3
@@ -0,0 +1,97 @@
+import os
+import shutil
+import pytest
+
+import process_directory as pd
+from result_cache import open_cache, file_key, lookup, store, prune, params_hash
+from color_lut import classes_from_parameters
+from gilgai_detection import load_slider_values
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES = os.path.join(ROOT, "images")
+PARAMETERS = os.path.join(ROOT, "parameters.json")
+
+
+@pytest.fixture
+def image(tmp_path):
+    img_path = str(tmp_path / "test1.png")
+    shutil.copy(os.path.join(IMAGES, "test1.png"), img_path)
+    return img_path
+
+
+@pytest.fixture
+def classes_hash():
+    return params_hash(classes_from_parameters(load_slider_values(PARAMETERS)))
+
+
+def test_changed_size_or_time_is_evicted(tmp_path, image, classes_hash):
+    cache = open_cache(str(tmp_path / "cache.sqlite"))
+    store(cache, image, file_key(image), classes_hash, [1.0, 2.0])
+    assert lookup(cache, image, file_key(image), classes_hash) == [1.0, 2.0]
+
+    stat = os.stat(image)
+    os.utime(image, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert lookup(cache, image, file_key(image), classes_hash) is None
+    assert cache.execute("SELECT COUNT(*) FROM results").fetchone()[0] == 0
+
+    store(cache, image, file_key(image), classes_hash, [1.0, 2.0])
+    with open(image, "ab") as img_file:
+        img_file.write(b"\0")
+    assert lookup(cache, image, file_key(image), classes_hash) is None
+
+
+def test_other_thresholds_miss(tmp_path, image, classes_hash):
+    cache = open_cache(str(tmp_path / "cache.sqlite"))
+    store(cache, image, file_key(image), classes_hash, [1.0, 2.0])
+    assert lookup(cache, image, file_key(image), params_hash((("Green", (0, 0, 0), (1, 1, 1)),))) is None
+    assert lookup(cache, image, file_key(image), classes_hash) == [1.0, 2.0]
+
+
+def test_content_hash_catches_in_place_rewrite(tmp_path, image, classes_hash):
+    cache = open_cache(str(tmp_path / "cache.sqlite"))
+    store(cache, image, file_key(image, hash_contents=True), classes_hash, [1.0, 2.0])
+
+    # Same size and modification time, different bytes
+    stat = os.stat(image)
+    with open(image, "r+b") as img_file:
+        img_file.seek(-1, os.SEEK_END)
+        last = img_file.read(1)
+        img_file.seek(-1, os.SEEK_END)
+        img_file.write(b"\1" if last != b"\1" else b"\2")
+    os.utime(image, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    assert lookup(cache, image, file_key(image), classes_hash) == [1.0, 2.0]
+    assert lookup(cache, image, file_key(image, hash_contents=True), classes_hash) is None
+
+
+def test_prune_removes_missing_files_and_old_entries(tmp_path, image, classes_hash):
+    cache = open_cache(str(tmp_path / "cache.sqlite"))
+    store(cache, image, file_key(image), classes_hash, [1.0, 2.0])
+    store(cache, image, file_key(image), "old thresholds", [3.0, 4.0])
+    cache.execute("UPDATE results SET last_used = 0 WHERE params_hash = 'old thresholds'")
+    prune(cache)
+    assert cache.execute("SELECT params_hash FROM results").fetchall() == [(classes_hash,)]
+
+    os.remove(image)
+    prune(cache)
+    assert cache.execute("SELECT COUNT(*) FROM results").fetchone()[0] == 0
+
+
+def test_second_run_is_answered_from_the_cache(tmp_path, monkeypatch):
+    image_directory = tmp_path / "images"
+    shutil.copytree(IMAGES, image_directory)
+    cache_path = str(tmp_path / "cache.sqlite")
+    pd.process_directory(str(image_directory), PARAMETERS, str(tmp_path / "first.csv"), cache_path=cache_path)
+
+    # Only the changed image is processed again
+    with open(image_directory / "test2.png", "ab") as img_file:
+        img_file.write(b"\0")
+    processed = []
+    process_image = pd.process_image
+    monkeypatch.setattr(pd, "process_image", lambda img_path, **kwargs: processed.append(img_path) or
+                        process_image(img_path, **kwargs))
+    pd.process_directory(str(image_directory), PARAMETERS, str(tmp_path / "second.csv"), cache_path=cache_path)
+
+    assert processed == [str(image_directory / "test2.png")]
+    with open(tmp_path / "first.csv") as first, open(tmp_path / "second.csv") as second:
+        assert first.read() == second.read()
@@ -0,0 +1,43 @@
+import os
+import csv
+import shutil
+
+from shards import write_manifest, run_shard, merge_shards, shard_csv_path
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES = os.path.join(ROOT, "images")
+PARAMETERS = os.path.join(ROOT, "parameters.json")
+
+
+def test_rerun_shard_is_merged_once(tmp_path):
+    image_directory = tmp_path / "survey"
+    for folder in ("paddock_a", "paddock_b"):
+        shutil.copytree(IMAGES, image_directory / folder)
+    manifest_path = str(tmp_path / "manifest.txt")
+    file_names = write_manifest(str(image_directory), manifest_path)
+    output_directory = str(tmp_path / "shards")
+    os.makedirs(output_directory)
+
+    for index in range(3):
+        run_shard(str(image_directory), index, 3, output_directory, PARAMETERS, manifest_path)
+    # Shard 1 run again after a failure, which left a partial CSV behind
+    with open(f"{shard_csv_path(output_directory, 1, 3)}.partial", "w") as partial_file:
+        partial_file.write("Image Name\npaddock_a/test1.png\n")
+    run_shard(str(image_directory), 1, 3, output_directory, PARAMETERS, manifest_path)
+
+    shard_rows = 0
+    for index in range(3):
+        with open(shard_csv_path(output_directory, index, 3), newline="") as csv_file:
+            shard_rows += len(list(csv.reader(csv_file))) - 1
+    assert shard_rows == len(file_names)
+
+    merged_path = str(tmp_path / "merged.csv")
+    assert merge_shards(output_directory, merged_path, manifest_path) == []
+    with open(merged_path, newline="") as csv_file:
+        rows = list(csv.reader(csv_file))[1:]
+    assert [row[0] for row in rows] == sorted(file_names)
+
+    with open(os.path.join(ROOT, "output.csv"), newline="") as csv_file:
+        expected = {row[0]: row[1:] for row in list(csv.reader(csv_file))[1:]}
+    for row in rows:
+        assert row[1:3] == expected[os.path.basename(row[0])]
@@ -0,0 +1,34 @@
+import os
+import cv2
+import numpy as np
+import pytest
+
+from tiled import tile_coverage
+from color_lut import classes_from_parameters, classify
+from gilgai_detection import load_slider_values
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLASSES = classes_from_parameters(load_slider_values(os.path.join(ROOT, "parameters.json")))
+
+
+@pytest.fixture
+def image():
+    return np.tile(cv2.imread(os.path.join(ROOT, "images", "test1.png")), (3, 3, 1))
+
+
+@pytest.mark.parametrize("layout", [{"tile": (256, 256)}, {"rowsperstrip": 37}])
+def test_compressed_tiff_is_read_in_windows(tmp_path, image, layout):
+    tifffile = pytest.importorskip("tifffile")
+    path = str(tmp_path / "ortho.tif")
+    tifffile.imwrite(path, cv2.cvtColor(image, cv2.COLOR_BGR2RGB), compression="zlib", **layout)
+
+    percentages, _ = tile_coverage(path, CLASSES, tile_size=300)
+    assert np.allclose(percentages, classify(image, CLASSES)[1])
+
+
+def test_single_band_npy(tmp_path, image):
+    grey = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    np.save(tmp_path / "grey.npy", grey)
+
+    percentages, _ = tile_coverage(str(tmp_path / "grey.npy"), CLASSES, tile_size=300)
+    assert np.allclose(percentages, classify(cv2.cvtColor(grey, cv2.COLOR_GRAY2BGR), CLASSES)[1])
@@ -0,0 +1,43 @@
+import os
+import cv2
+import queue
+import threading
+import numpy as np
+import pytest
+
+from video_stream import capture_frames, process_stream
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PARAMETERS = os.path.join(ROOT, "parameters.json")
+
+
+class BrokenCapture:
+    def get(self, prop):
+        return 10
+
+    def grab(self):
+        raise RuntimeError("camera unplugged")
+
+
+def test_capture_error_is_passed_to_reader():
+    frames = queue.Queue()
+    capture_frames(BrokenCapture(), frames, {"captured": 0, "dropped": 0}, threading.Event())
+    error = frames.get_nowait()
+    assert isinstance(error, RuntimeError)
+
+
+@pytest.mark.parametrize("options", [{"frame_step": 0}, {"scale": 0}])
+def test_invalid_options_are_rejected(tmp_path, options):
+    with pytest.raises(ValueError):
+        process_stream("missing.avi", PARAMETERS, str(tmp_path / "coverage.csv"), **options)
+
+
+def test_video_file(tmp_path):
+    video_path = str(tmp_path / "clip.avi")
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*"MJPG"), 10, (64, 48))
+    for _ in range(5):
+        writer.write(np.full((48, 64, 3), (40, 140, 70), np.uint8))
+    writer.release()
+
+    stats = process_stream(video_path, PARAMETERS, str(tmp_path / "coverage.csv"), frame_step=2)
+    assert stats["processed"] == 3
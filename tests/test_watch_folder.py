@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+import shutil
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES = os.path.join(ROOT, "images")
+
+
+def wait_for_rows(csv_path, count, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if os.path.exists(csv_path):
+            with open(csv_path) as csv_file:
+                if len(csv_file.read().splitlines()) >= count + 1:
+                    return True
+        time.sleep(0.1)
+
+    return False
+
+
+def test_partial_parameters_keep_last_thresholds(tmp_path):
+    image_directory = tmp_path / "images"
+    image_directory.mkdir()
+    shutil.copy(os.path.join(IMAGES, "test1.png"), image_directory)
+    parameters_path = tmp_path / "parameters.json"
+    shutil.copy(os.path.join(ROOT, "parameters.json"), parameters_path)
+    csv_path = str(tmp_path / "output.csv")
+
+    watcher = subprocess.Popen([sys.executable, os.path.join(ROOT, "watch_folder.py"), str(image_directory),
+                                "--parameters", str(parameters_path), "--output", csv_path, "--poll",
+                                "--interval", "0.1", "--settle", "0.2"], cwd=ROOT)
+    try:
+        assert wait_for_rows(csv_path, 1)
+
+        # A half-saved parameter file, then the file missing, while a new image arrives
+        parameters_path.write_text('{"Green H lower": 2')
+        shutil.copy(os.path.join(IMAGES, "test2.png"), image_directory)
+        assert wait_for_rows(csv_path, 2)
+        parameters_path.unlink()
+        shutil.copy(os.path.join(IMAGES, "twitter_test.png"), image_directory)
+        assert wait_for_rows(csv_path, 3)
+        assert watcher.poll() is None
+    finally:
+        watcher.kill()
+        watcher.wait()
+
+
+def test_truncated_image_at_startup_is_skipped(tmp_path):
+    image_directory = tmp_path / "images"
+    image_directory.mkdir()
+    shutil.copy(os.path.join(IMAGES, "test1.png"), image_directory)
+    with open(os.path.join(IMAGES, "test2.png"), "rb") as png_file:
+        (image_directory / "truncated.png").write_bytes(png_file.read()[:2000])
+    old = time.time() - 60
+    for image_path in image_directory.iterdir():
+        os.utime(image_path, (old, old))
+    csv_path = str(tmp_path / "output.csv")
+
+    watcher = subprocess.Popen([sys.executable, os.path.join(ROOT, "watch_folder.py"), str(image_directory),
+                                "--parameters", os.path.join(ROOT, "parameters.json"), "--output", csv_path, "--poll",
+                                "--interval", "0.1", "--settle", "0.2"], cwd=ROOT)
+    try:
+        assert wait_for_rows(csv_path, 1)
+        shutil.copy(os.path.join(IMAGES, "twitter_test.png"), image_directory)
+        assert wait_for_rows(csv_path, 2)
+        assert watcher.poll() is None
+        with open(csv_path) as csv_file:
+            assert "truncated.png" not in csv_file.read()
+    finally:
+        watcher.kill()
+        watcher.wait()
@@ -0,0 +1,177 @@
+import os
+import cv2
+import csv
+import argparse
+import numpy as np
+
+from color_lut import classify_counts
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+class TiffWindows:
+    # Reads a window of a TIFF by decoding only the tiles or strips it overlaps, so compressed orthomosaics are never
+    # decoded whole. Windows are always (height, width, samples).
+
+    def __init__(self, img_path):
+        self.tiff = tifffile.TiffFile(img_path)
+        self.page = self.tiff.pages.first
+        height, width = self.page.imagelength, self.page.imagewidth
+        self.shape = (height, width, self.page.samplesperpixel)
+        self.chunk_height, self.chunk_width = self.page.chunks[:2]
+        self.chunks_across = -(-width // self.chunk_width)
+        # With separate planes each sample has its own set of tiles or strips, one after the other
+        self.planes = self.shape[2] if self.page.planarconfig == 2 else 1
+        self.chunks_per_plane = len(self.page.dataoffsets) // self.planes
+
+    def __getitem__(self, window):
+        y0, y1, _ = window[0].indices(self.shape[0])
+        x0, x1, _ = window[1].indices(self.shape[1])
+        out = np.empty((y1 - y0, x1 - x0, self.shape[2]), self.page.dtype)
+
+        for plane in range(self.planes):
+            samples = slice(plane, plane + 1) if self.planes > 1 else slice(None)
+            for row in range(y0 // self.chunk_height, -(-y1 // self.chunk_height)):
+                for col in range(x0 // self.chunk_width, -(-x1 // self.chunk_width)):
+                    index = plane * self.chunks_per_plane + row * self.chunks_across + col
+                    self.tiff.filehandle.seek(self.page.dataoffsets[index])
+                    data = self.tiff.filehandle.read(self.page.databytecounts[index]) or None
+                    segment = self.page.decode(data, index)[0][0]
+
+                    # Edge tiles are padded to the full tile size, only the part inside the window is copied
+                    top, left = row * self.chunk_height, col * self.chunk_width
+                    sy0, sy1 = max(y0, top), min(y1, top + segment.shape[0])
+                    sx0, sx1 = max(x0, left), min(x1, left + segment.shape[1])
+                    out[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0, samples] = \
+                        segment[sy0 - top:sy1 - top, sx0 - left:sx1 - left].reshape(sy1 - sy0, sx1 - sx0, -1)
+
+        return out[(slice(None), slice(None)) + tuple(window[2:])]
+
+    def close(self):
+        self.tiff.close()
+
+
+def open_image(img_path, shape=None):
+    # Returns the image and its channel order, memory-mapped or read in windows whenever the file format allows it
+    extension = os.path.splitext(img_path)[1].lower()
+    if extension == ".npy":
+        return np.load(img_path, mmap_mode="r"), "BGR"
+
+    if extension == ".raw":
+        if shape is None:
+            raise ValueError("The (height, width) of a raw image must be given to read it.")
+        return np.memmap(img_path, dtype=np.uint8, mode="r", shape=(shape[0], shape[1], 3)), "BGR"
+
+    if extension in (".tif", ".tiff") and tifffile is not None:
+        try:
+            # Uncompressed, contiguous TIFFs are mapped straight from the file
+            return tifffile.memmap(img_path, mode="r"), "RGB"
+        except ValueError:
+            pass
+
+        # Compressed or tiled TIFFs (e.g. GeoTIFF orthomosaics) are decoded one tile or strip at a time
+        return TiffWindows(img_path), "RGB"
+
+    # JPEG and PNG can't be read in windows, so these are decoded whole but still classified one tile at a time.
+    # OpenCV refuses images over 2^30 pixels unless OPENCV_IO_MAX_IMAGE_PIXELS is raised.
+    img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise ValueError(f"Could not read {img_path}. Images over 2^30 pixels need OPENCV_IO_MAX_IMAGE_PIXELS set, "
+                         f"or converting to a tiled TIFF (with tifffile installed).")
+
+    return img, "BGR"
+
+
+def tile_bgr(tile, channel_order):
+    # Single-band images are classified as grey, any alpha or extra bands are ignored
+    if tile.ndim == 2 or tile.shape[2] == 1:
+        return cv2.cvtColor(np.ascontiguousarray(tile.reshape(tile.shape[:2])), cv2.COLOR_GRAY2BGR)
+
+    tile = np.ascontiguousarray(tile[..., :3])
+    return cv2.cvtColor(tile, cv2.COLOR_RGB2BGR) if channel_order == "RGB" else tile
+
+
+def iter_windows(height, width, tile_size):
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            yield y, min(y + tile_size, height), x, min(x + tile_size, width)
+
+
+def cell_coverage(labels, n_classes, cell_size):
+    # Percentage of each raster cell covered by each class, edge cells are scaled by their true pixel count
+    rows = np.arange(0, labels.shape[0], cell_size)
+    cols = np.arange(0, labels.shape[1], cell_size)
+    cell_pixels = np.outer(np.diff(np.append(rows, labels.shape[0])), np.diff(np.append(cols, labels.shape[1])))
+
+    coverage = np.empty((len(rows), len(cols), n_classes), np.float32)
+    for bit in range(n_classes):
+        class_pixels = ((labels >> bit) & 1).astype(np.uint32)
+        class_pixels = np.add.reduceat(np.add.reduceat(class_pixels, rows, axis=0), cols, axis=1)
+        coverage[..., bit] = class_pixels / cell_pixels * 100
+
+    return coverage
+
+
+def tile_coverage(img_path, classes, tile_size=4096, cell_size=None, shape=None):
+    if cell_size is not None and tile_size % cell_size:
+        raise ValueError(f"The tile size ({tile_size}) must be a multiple of the raster cell size ({cell_size}).")
+
+    img, channel_order = open_image(img_path, shape)
+    height, width = img.shape[:2]
+    counts = np.zeros(len(classes), np.int64)
+    raster = None
+    if cell_size is not None:
+        raster = np.zeros((-(-height // cell_size), -(-width // cell_size), len(classes)), np.float32)
+
+    # Only one tile is ever copied out of the source, so peak memory is set by the tile size
+    try:
+        for y0, y1, x0, x1 in iter_windows(height, width, tile_size):
+            tile = tile_bgr(img[y0:y1, x0:x1], channel_order)
+            labels, tile_counts = classify_counts(tile, classes, keep_labels=raster is not None)
+            counts += tile_counts
+
+            if raster is not None:
+                raster[y0 // cell_size:-(-y1 // cell_size), x0 // cell_size:-(-x1 // cell_size)] = \
+                    cell_coverage(labels, len(classes), cell_size)
+    finally:
+        if isinstance(img, TiffWindows):
+            img.close()
+
+    percentages = [count / (height * width) * 100 for count in counts]
+
+    return percentages, raster
+
+
+if __name__ == "__main__":
+    from gilgai_detection import load_slider_values
+    from color_lut import classes_from_parameters
+    from process_directory import image_result, csv_header, csv_row
+
+    parser = argparse.ArgumentParser(description="Calculate coverage for a very large image (e.g. an orthomosaic) "
+                                                 "one tile at a time.")
+    parser.add_argument("image_path", help="image file, .npy array or .raw BGR bytes (with --shape)")
+    parser.add_argument("--parameters", default="parameters.json")
+    parser.add_argument("--output", default="output.csv")
+    parser.add_argument("--tile-size", type=int, default=4096)
+    parser.add_argument("--shape", type=int, nargs=2, metavar=("HEIGHT", "WIDTH"), help="size of a .raw image")
+    parser.add_argument("--raster-cell", type=int, help="also save a coverage raster with cells of this many pixels")
+    parser.add_argument("--raster", default="coverage.npy", help="where to save the coverage raster")
+    args = parser.parse_args()
+
+    parameters = load_slider_values(args.parameters)
+    if parameters is None:
+        print("Error: No JSON file found.")
+    else:
+        classes = classes_from_parameters(parameters)
+        percentages, raster = tile_coverage(args.image_path, classes, args.tile_size, args.raster_cell, args.shape)
+
+        with open(args.output, "w", newline="") as csv_file:
+            csv_writer = csv.writer(csv_file)
+            csv_writer.writerow(csv_header(classes))
+            csv_writer.writerow(csv_row(image_result(args.image_path, classes, percentages)))
+
+        if raster is not None:
+            np.save(args.raster, raster)
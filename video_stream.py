@@ -0,0 +1,152 @@
+import cv2
+import csv
+import time
+import queue
+import argparse
+import threading
+
+from gilgai_detection import load_slider_values
+from color_lut import classes_from_parameters, classify
+from process_directory import CLASS_LABELS
+
+# What the capture thread does when classification falls behind and the queue is full:
+# "none" waits (no frames lost, right for video files), "oldest" replaces the oldest waiting frame and
+# "newest" drops the frame just captured (both keep a live camera running in real time)
+DROP_POLICIES = ("none", "oldest", "newest")
+
+# Put on the queue by the capture thread once there are no more frames
+END_OF_STREAM = None
+
+
+def open_capture(source):
+    # A number selects a local camera, anything else is a video file or stream URL
+    capture = cv2.VideoCapture(int(source) if str(source).isdigit() else source)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video source {source}.")
+
+    return capture
+
+
+def capture_frames(capture, frames, stats, stop_event, frame_step=1, drop="none", scale=None):
+    # Runs on its own thread so decoding overlaps with classification of the previous frames
+    # Anything that goes wrong is put on the queue in place of END_OF_STREAM and raised again by the reader
+    failure = None
+    try:
+        live = capture.get(cv2.CAP_PROP_FRAME_COUNT) <= 0
+        start = time.monotonic()
+        frame_index = -1
+
+        while not stop_event.is_set():
+            # Skipped frames are only grabbed, not decoded
+            frame_index += 1
+            if not capture.grab():
+                break
+            if frame_index % frame_step:
+                continue
+
+            ok, frame = capture.retrieve()
+            if not ok:
+                break
+            timestamp = time.monotonic() - start if live else capture.get(cv2.CAP_PROP_POS_MSEC) / 1000
+            if scale is not None:
+                frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            stats["captured"] += 1
+
+            if drop == "none":
+                frames.put((frame_index, timestamp, frame))
+                continue
+
+            try:
+                frames.put_nowait((frame_index, timestamp, frame))
+            except queue.Full:
+                stats["dropped"] += 1
+                if drop == "oldest":
+                    try:
+                        frames.get_nowait()
+                    except queue.Empty:
+                        pass
+                    frames.put_nowait((frame_index, timestamp, frame))
+    except Exception as error:
+        failure = error
+    finally:
+        frames.put(END_OF_STREAM if failure is None else failure)
+
+
+def process_stream(source, json_file_path="parameters.json", output_csv_path="coverage.csv", frame_step=1,
+                   queue_size=8, drop="none", scale=None, max_frames=None, progress=None):
+    # Load the slider values from the JSON file
+    parameters = load_slider_values(json_file_path)
+    if parameters is None:
+        print("Error: No JSON file found.")
+        return
+
+    if frame_step < 1:
+        raise ValueError(f"The frame step must be at least 1, got {frame_step}.")
+    if scale is not None and scale <= 0:
+        raise ValueError(f"The scale must be above 0, got {scale}.")
+
+    classes = classes_from_parameters(parameters)
+
+    capture = open_capture(source)
+    frames = queue.Queue(maxsize=queue_size)
+    stats = {"captured": 0, "dropped": 0, "processed": 0}
+    stop_event = threading.Event()
+    capture_thread = threading.Thread(target=capture_frames, daemon=True,
+                                      args=(capture, frames, stats, stop_event, frame_step, drop, scale))
+    capture_thread.start()
+
+    try:
+        with open(output_csv_path, "w", newline="") as csv_file:
+            csv_writer = csv.writer(csv_file)
+            csv_writer.writerow(["Frame", "Time (s)"] + [f"{CLASS_LABELS.get(name, name)} (%)"
+                                                         for name, _, _ in classes])
+
+            # Classify frames as they come off the queue and write a row for each
+            while True:
+                item = frames.get()
+                if item is END_OF_STREAM:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                frame_index, timestamp, frame = item
+                _, percentages = classify(frame, classes, keep_labels=False)
+                csv_writer.writerow([frame_index, f"{timestamp:.3f}"] + percentages)
+                stats["processed"] += 1
+
+                if progress is not None:
+                    progress(frame_index, timestamp, percentages)
+                if max_frames is not None and stats["processed"] >= max_frames:
+                    break
+    finally:
+        stop_event.set()
+        # Unblock the capture thread if it is waiting on a full queue
+        while capture_thread.is_alive():
+            try:
+                frames.get_nowait()
+            except queue.Empty:
+                pass
+            capture_thread.join(timeout=0.1)
+        capture.release()
+
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calculate wheat and gilgai coverage for every frame of a video "
+                                                 "file or camera.")
+    parser.add_argument("source", help="video file, stream URL or camera number (e.g. 0)")
+    parser.add_argument("--parameters", default="parameters.json")
+    parser.add_argument("--output", default="coverage.csv")
+    parser.add_argument("--frame-step", type=int, default=1, help="only classify every Nth frame")
+    parser.add_argument("--queue-size", type=int, default=8, help="frames waiting between capture and classification")
+    parser.add_argument("--drop", choices=DROP_POLICIES, default="none",
+                        help="what to do with frames when classification falls behind")
+    parser.add_argument("--scale", type=float, help="resize frames by this factor before classifying")
+    parser.add_argument("--max-frames", type=int, help="stop after classifying this many frames")
+    args = parser.parse_args()
+
+    stats = process_stream(args.source, args.parameters, args.output, args.frame_step, args.queue_size, args.drop,
+                           args.scale, args.max_frames)
+    if stats is not None:
+        print(f"Captured {stats['captured']} frames, classified {stats['processed']} and dropped {stats['dropped']}.")
@@ -0,0 +1,226 @@
+import os
+import csv
+import json
+import time
+import argparse
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+from gilgai_detection import load_slider_values
+from color_lut import classes_from_parameters
+from result_cache import params_hash
+from process_directory import IMAGE_EXTENSIONS, list_images, iter_directory, csv_header, csv_row, print_progress
+
+# How often the folder is checked without inotify, and how long a file's size and time must stay the same before
+# it is taken to be completely written
+POLL_SECONDS = 1.0
+SETTLE_SECONDS = 2.0
+
+
+class SettleCheck:
+    # Files are only passed on once they are completely written: their size and modification time have stayed the
+    # same for `settle` seconds, or were last changed longer ago than that
+
+    def __init__(self, image_directory, settle=SETTLE_SECONDS):
+        self.image_directory = image_directory
+        self.settle = settle
+        self.pending = {}
+
+    def add(self, file_names):
+        for file_name in file_names:
+            self.pending.setdefault(file_name, (None, time.monotonic()))
+
+    def discard(self, file_names):
+        for file_name in file_names:
+            self.pending.pop(file_name, None)
+
+    def finished(self):
+        finished = []
+        for file_name, (key, since) in list(self.pending.items()):
+            try:
+                stat = os.stat(os.path.join(self.image_directory, file_name))
+            except FileNotFoundError:
+                del self.pending[file_name]
+                continue
+
+            if key is None and time.time() - stat.st_mtime >= self.settle:
+                del self.pending[file_name]
+                finished.append(file_name)
+            elif (stat.st_size, stat.st_mtime_ns) != key:
+                self.pending[file_name] = ((stat.st_size, stat.st_mtime_ns), time.monotonic())
+            elif time.monotonic() - since >= self.settle:
+                del self.pending[file_name]
+                finished.append(file_name)
+
+        return finished
+
+
+class InotifyWatcher:
+    # The kernel reports a file once the program writing it closes it (or moves it in), so nothing is read half-written.
+    # Files that were there before watching began have no event to wait for, so they go through the settle check.
+
+    def __init__(self, image_directory, settle=SETTLE_SECONDS):
+        self.inotify = INotify()
+        self.inotify.add_watch(image_directory, flags.CLOSE_WRITE | flags.MOVED_TO)
+        self.settle_check = SettleCheck(image_directory, settle)
+
+    def add(self, file_names):
+        self.settle_check.add(file_names)
+
+    def wait(self, timeout):
+        closed = [event.name for event in self.inotify.read(timeout=int(timeout * 1000))
+                  if event.name.lower().endswith(IMAGE_EXTENSIONS)]
+        self.settle_check.discard(closed)
+
+        return closed + self.settle_check.finished()
+
+    def close(self):
+        self.inotify.close()
+
+
+class PollWatcher:
+    # Without inotify (e.g. Windows, macOS or a network share) the folder is only listed again when its modification
+    # time changes, and new files are then checked until they stop changing
+
+    def __init__(self, image_directory, settle=SETTLE_SECONDS):
+        self.image_directory = image_directory
+        self.directory_mtime = os.stat(image_directory).st_mtime_ns
+        self.known = set(list_images(image_directory))
+        self.settle_check = SettleCheck(image_directory, settle)
+
+    def add(self, file_names):
+        self.settle_check.add(file_names)
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+
+        directory_mtime = os.stat(self.image_directory).st_mtime_ns
+        if directory_mtime != self.directory_mtime:
+            self.directory_mtime = directory_mtime
+            listed = set(list_images(self.image_directory))
+            self.settle_check.add(listed - self.known)
+            self.known = listed
+
+        return self.settle_check.finished()
+
+    def close(self):
+        pass
+
+
+def state_path(output_csv_path):
+    return os.path.splitext(output_csv_path)[0] + "_watch.json"
+
+
+def read_done(output_csv_path, classes, intervals=False):
+    # Images already in the CSV, or None if it was written with other thresholds and has to be made again
+    try:
+        with open(state_path(output_csv_path)) as json_file:
+            state = json.load(json_file)
+        with open(output_csv_path, newline="") as csv_file:
+            csv_reader = csv.reader(csv_file)
+            if next(csv_reader, None) != csv_header(classes, intervals):
+                return None
+            done = {row[0] for row in csv_reader if row}
+    except (FileNotFoundError, ValueError):
+        return None
+
+    return done if state.get("params_hash") == params_hash(classes) else None
+
+
+def write_state(output_csv_path, classes):
+    with open(state_path(output_csv_path), "w") as json_file:
+        json.dump({"params_hash": params_hash(classes)}, json_file)
+
+
+def start_csv(output_csv_path, classes, intervals=False):
+    with open(output_csv_path, "w", newline="") as csv_file:
+        csv.writer(csv_file).writerow(csv_header(classes, intervals))
+
+
+def append_images(image_directory, parameters, output_csv_path, file_names, **options):
+    # Images that can't be decoded are reported and left out of the CSV, they are tried again if they arrive again
+    appended = []
+    with open(output_csv_path, "a", newline="") as csv_file:
+        csv_writer = csv.writer(csv_file)
+        for result in iter_directory(image_directory, parameters, file_names=file_names, skip_errors=True, **options):
+            csv_writer.writerow(csv_row(result))
+            csv_file.flush()
+            appended.append(result["file_name"])
+
+    return appended
+
+
+def watch_directory(image_directory, json_file_path="parameters.json", output_csv_path="output.csv", poll=False,
+                    settle=SETTLE_SECONDS, interval=POLL_SECONDS, **options):
+    # See iter_directory() for the options
+    parameters = load_slider_values(json_file_path)
+    if parameters is None:
+        print("Error: No JSON file found.")
+        return
+
+    if poll or INotify is None:
+        watcher = PollWatcher(image_directory, settle)
+    else:
+        watcher = InotifyWatcher(image_directory, settle)
+    parameters_mtime = os.stat(json_file_path).st_mtime_ns
+    done = None
+
+    try:
+        while True:
+            # The last thresholds that loaded are kept while the file is missing (saved by renaming a new file into
+            # place) or only partly written, and it is read again once it changes
+            try:
+                mtime = os.stat(json_file_path).st_mtime_ns
+            except FileNotFoundError:
+                mtime = parameters_mtime
+            if mtime != parameters_mtime:
+                try:
+                    latest = load_slider_values(json_file_path)
+                except ValueError:
+                    latest = None
+                if latest is not None:
+                    parameters, parameters_mtime = latest, mtime
+                    done = None
+
+            # Only a change to the thresholds means processing every image again
+            if done is None:
+                classes = classes_from_parameters(parameters)
+                intervals = options.get("estimate") is not None
+                done = read_done(output_csv_path, classes, intervals)
+                if done is None:
+                    print(f"Processing every image in {image_directory} with the thresholds in {json_file_path}")
+                    start_csv(output_csv_path, classes, intervals)
+                    write_state(output_csv_path, classes)
+                    done = set()
+
+                # Anything that arrived while nothing was watching, or every image after a threshold change. They
+                # are checked like new files, so one that is still being copied isn't read half-written.
+                watcher.add(file_name for file_name in list_images(image_directory) if file_name not in done)
+
+            new = sorted(set(file_name for file_name in watcher.wait(interval) if file_name not in done))
+            if new:
+                done.update(append_images(image_directory, parameters, output_csv_path, new, **options))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep the coverage CSV up to date as images are added to a directory.")
+    parser.add_argument("image_directory", nargs="?", default="images")
+    parser.add_argument("--parameters", default="parameters.json", help="threshold values saved by gilgai_detection.py")
+    parser.add_argument("--output", default="output.csv")
+    parser.add_argument("--workers", type=int, default=1, help="number of parallel workers (0 = one per core)")
+    parser.add_argument("--poll", action="store_true", help="check the directory for changes instead of using inotify")
+    parser.add_argument("--interval", type=float, default=POLL_SECONDS, help="seconds between checks")
+    parser.add_argument("--settle", type=float, default=SETTLE_SECONDS,
+                        help="seconds a file must stay unchanged before it is processed, for every new file with "
+                             "--poll, otherwise for files that were already there")
+    args = parser.parse_args()
+
+    watch_directory(args.image_directory, args.parameters, args.output, args.poll, args.settle, args.interval,
+                    workers=args.workers or None, progress=print_progress)